@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 SMHI
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load benchmark of the trollcast server.
+
+Synthesizes a valid HRPT stream at a multiple of real time in the watched
+directory, runs the server on it, and drives stand-in clients against the
+responder. Reports the ingest throughput, the latency of the "have"
+announcements, and the latency of the scanline requests.
+"""
+from __future__ import with_statement
+
+import logging
+import os
+import random
+import time
+from ConfigParser import ConfigParser
+from datetime import datetime, timedelta
+from threading import Thread
+
+import numpy as np
+from posttroll.message import strp_isoformat
+from posttroll.subscriber import Subscriber
+from watchdog.observers import Observer
+from zmq import ROUTER
+
+from trollcast.client import Requester, decode_haves
+from trollcast.server import (Holder, FileStreamer, Responder, HRPT_SYNC,
+                              HRPT_SYNC_START, LINE_SIZE, to_msecs)
+
+LINES_PER_SECOND = 6
+
+
+def line_offsets(nb_lines):
+    """Get the time offsets of *nb_lines* lines, in milliseconds, rounded
+    like the timecodes of the satellites.
+    """
+    return ((np.arange(nb_lines) * 2000 + LINES_PER_SECOND)
+            // (2 * LINES_PER_SECOND))
+
+
+def synthesize(start_time, nb_lines):
+    """Make *nb_lines* valid HRPT frames starting at *start_time*, with
+    random image data.
+    """
+    words = np.random.randint(0, 1024, (nb_lines, LINE_SIZE // 2))
+    words = words.astype(np.uint16)
+    words[:, :6] = HRPT_SYNC_START
+    words[:, -100:] = HRPT_SYNC
+    msecs = (to_msecs(start_time) - to_msecs(datetime(start_time.year, 1, 1))
+             + line_offsets(nb_lines))
+    day = msecs // 86400000 + 1
+    msecs %= 86400000
+    words[:, 8] = day * 2
+    words[:, 9] = (msecs >> 20) & 127
+    words[:, 10] = (msecs >> 10) & 1023
+    words[:, 11] = msecs & 1023
+    return words.astype(">u2")
+
+
+class Writer(Thread):
+    """Write a synthetic pass of *duration* seconds in *path*, *speed* times
+    faster than real time.
+    """
+
+    def __init__(self, path, duration, speed):
+        Thread.__init__(self)
+        self.start_time = datetime.utcnow().replace(microsecond=0)
+        self.filename = os.path.join(path,
+                                     self.start_time.strftime("%Y%m%d%H%M%S")
+                                     + "_NOAA_18.temp")
+        self.nb_lines = int(duration * LINES_PER_SECOND)
+        self.speed = speed
+        self.written = {}
+        self.first_write = None
+        self.last_write = None
+
+    def run(self):
+        frames = synthesize(self.start_time, self.nb_lines)
+        offsets = line_offsets(self.nb_lines)
+        period = 1.0 / (LINES_PER_SECOND * self.speed)
+        self.first_write = time.time()
+        with open(self.filename, "wb") as fp_:
+            for i, frame in enumerate(frames):
+                fp_.write(frame.tostring())
+                fp_.flush()
+                self.written[to_msecs(self.start_time)
+                             + int(offsets[i])] = time.time()
+                delay = self.first_write + (i + 1) * period - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        self.last_write = time.time()
+
+
+class HaveListener(Thread):
+    """Record when the announcement of each line is received.
+    """
+
+    def __init__(self, address):
+        Thread.__init__(self)
+        self._sub = Subscriber([address], "")
+        self.received = {}
+
+    def run(self):
+        for message in self._sub.recv(1):
+            if message is None:
+                continue
+            now = time.time()
+            if message.type == "have":
+                utctime = strp_isoformat(message.data["timecode"])
+                self.received[to_msecs(utctime)] = now
+            elif message.type == "haves":
+                for utctime, elevation in decode_haves(message.data):
+                    self.received[to_msecs(utctime)] = now
+
+    def stop(self):
+        """Stop listening.
+        """
+        self._sub.stop()
+
+
+class StandIn(Thread):
+    """Stand-in client, asking for random lines among the announced ones.
+    """
+
+    def __init__(self, host, port, satellite, listener, nb_requests, packed):
+        Thread.__init__(self)
+        self._requester = Requester(host, port, packed)
+        self._satellite = satellite
+        self._listener = listener
+        self._nb_requests = nb_requests
+        self.latencies = []
+        self.failures = 0
+
+    def run(self):
+        while len(self.latencies) + self.failures < self._nb_requests:
+            known = self._listener.received.keys()
+            if not known:
+                time.sleep(0.1)
+                continue
+            utctime = (datetime(1970, 1, 1) +
+                       timedelta(milliseconds=random.choice(known)))
+            start = time.time()
+            try:
+                self._requester.get_line(self._satellite, utctime)
+            except IOError:
+                self.failures += 1
+                # the REQ socket is stuck after a timeout, start over
+                self._requester.stop()
+                self._requester = Requester(self._requester._host,
+                                            self._requester._port,
+                                            self._requester._packed)
+                continue
+            self.latencies.append(time.time() - start)
+        self._requester.stop()
+
+
+def percentiles(values):
+    """Format the median and tail percentiles of *values* in milliseconds.
+    """
+    if len(values) == 0:
+        return "n/a"
+    values = np.array(values) * 1000
+    return ("p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms"
+            % (np.percentile(values, 50), np.percentile(values, 90),
+               np.percentile(values, 99), values.max()))
+
+
+def main():
+    """Run the benchmark.
+    """
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--config_file", required=True,
+                        help="eg. sattorrent_local.cfg")
+    parser.add_argument("-d", "--duration", type=float, default=60,
+                        help="length of the synthetic pass, in seconds")
+    parser.add_argument("-s", "--speed", type=float, default=10,
+                        help="speed of the stream, in multiples of real time")
+    parser.add_argument("-c", "--clients", type=int, default=4,
+                        help="number of stand-in clients")
+    parser.add_argument("-r", "--requests", type=int, default=200,
+                        help="number of requests per client")
+    parser.add_argument("-p", "--packed", action="store_true",
+                        help="ask for packed scanlines")
+    args = parser.parse_args()
+
+    # the server logs every line at debug level
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("trollcast/server").setLevel(logging.WARNING)
+
+    cfg = ConfigParser()
+    cfg.read(args.config_file)
+    path = cfg.get("local_reception", "data_dir")
+    localhost = cfg.get("local_reception", "localhost")
+    hostname = cfg.get(localhost, "hostname")
+    pubport = cfg.get(localhost, "pubport")
+    reqport = cfg.get(localhost, "reqport")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    # the server
+    holder = Holder(args.config_file)
+    holder.start()
+    fstreamer = FileStreamer(holder, args.config_file)
+    notifier = Observer()
+    notifier.schedule(fstreamer, path, recursive=False)
+    notifier.start()
+    responder = Responder(holder, args.config_file,
+                          "tcp://*:" + reqport, ROUTER)
+    responder.start()
+
+    listener = HaveListener("tcp://" + hostname + ":" + pubport)
+    listener.start()
+    time.sleep(1)
+
+    writer = Writer(path, args.duration, args.speed)
+    clients = [StandIn(hostname, reqport, "NOAA 18", listener,
+                       args.requests, args.packed)
+               for i in range(args.clients)]
+    writer.start()
+    for client in clients:
+        client.start()
+
+    try:
+        writer.join()
+        for client in clients:
+            client.join()
+        # let the last announcements arrive
+        time.sleep(2)
+    finally:
+        listener.stop()
+        responder.stop()
+        notifier.stop()
+        notifier.join()
+        fstreamer.stop()
+        holder.stop()
+        os.remove(writer.filename)
+
+    received = listener.received
+    have_latencies = [received[msecs] - written
+                      for msecs, written in writer.written.items()
+                      if msecs in received]
+    ingest_time = max(received.values()) - writer.first_write
+    latencies = sum([client.latencies for client in clients], [])
+
+    print "Lines written:      %d in %.2f s" % (writer.nb_lines,
+                                                writer.last_write -
+                                                writer.first_write)
+    print "Lines ingested:     %d, %.1f lines/s" % (len(have_latencies),
+                                                    len(have_latencies) /
+                                                    ingest_time)
+    print "Have latency:       " + percentiles(have_latencies)
+    print "Requests served:    %d, %d failed" % (len(latencies),
+                                                 sum(client.failures
+                                                     for client in clients))
+    print "Request latency:    " + percentiles(latencies)
+    stats = holder.stats()
+    print "Cache:              " + str(stats["cache"])
+    print "Server counters:    " + str(stats["metrics"]["counters"])
+
+if __name__ == '__main__':
+    main()
@@ -25,15 +25,20 @@
 from __future__ import with_statement 
 
 import logging
-from ConfigParser import ConfigParser
+import mmap
+import time
+from base64 import b64decode
+from ConfigParser import ConfigParser, NoOptionError
 from Queue import Queue, Empty
 from datetime import timedelta, datetime
-from threading import Thread, Timer
+from heapq import heappop, heappush
+from threading import Thread, Condition, Lock
 
 import numpy as np
 from posttroll.message import Message, strp_isoformat
 from posttroll.subscriber import Subscriber
-from zmq import Context, REQ, LINGER, Poller, POLLIN
+from zmq import (Context, REQ, DEALER, LINGER, NOBLOCK, Poller, POLLIN,
+                 ZMQError)
 
 
 logger = logging.getLogger("client")
@@ -47,6 +52,62 @@ CLIENT_TIMEOUT = timedelta(seconds=5)
 
 BUFFER_TIME = 2.0
 
+EPOCH = datetime(1970, 1, 1)
+
+# Maximum number of lines asked for in one "scanline_range" request, and the
+# time to wait for its response, in milliseconds.
+BULK_SIZE = 600
+BULK_TIMEOUT = 10000
+
+# Time to wait for a scanline, in milliseconds.
+LINE_TIMEOUT = 1000
+
+# Default number of line requests in flight to each host, and the time to
+# wait for their responses when polling, in milliseconds.
+FETCH_WINDOW = 16
+FETCH_POLL = 10
+
+# Number of hosts a line is asked to before giving it up.
+FETCH_ATTEMPTS = 3
+
+# Weight of the expected response time of a host against the elevation of
+# its lines when choosing where to get a line, in degrees per second.
+LATENCY_WEIGHT = 10.0
+
+# Smoothing factor of the moving averages of the response time and failure
+# rate of the hosts, and the lowest success rate assumed for a host.
+EWMA_SMOOTHING = 0.1
+MIN_SUCCESS_RATE = 0.05
+
+def decode_haves(data):
+    """Get the (utctime, elevation) list of the lines of a "haves" message.
+    """
+    times = np.frombuffer(b64decode(data["timecodes"]), dtype="<i8")
+    elevations = np.frombuffer(b64decode(data["elevations"]), dtype="<f4")
+    return zip([EPOCH + timedelta(milliseconds=int(msecs))
+                for msecs in times],
+               elevations.tolist())
+
+def unpack_line(data):
+    """Unpack a line packed on 10 bits per word by the server. The first byte
+    gives the byte order of the words, "B" or "L", or is "R" for raw data.
+    """
+    flag, data = data[0], data[1:]
+    if flag == "R":
+        return data
+    packed = np.frombuffer(data, dtype=np.uint8).reshape(-1, 5)
+    packed = packed.astype(np.uint64)
+    bits = np.zeros(len(packed), dtype=np.uint64)
+    for i in range(5):
+        bits |= packed[:, i] << np.uint64(8 * (4 - i))
+    words = np.empty((len(packed), 4), dtype=np.uint16)
+    for i in range(4):
+        words[:, i] = (bits >> np.uint64(10 * (3 - i))) & np.uint64(1023)
+    words = words.ravel()[:LINE_SIZE // 2]
+    if flag == "B":
+        return words.astype(">u2").tostring()
+    return words.astype("<u2").tostring()
+
 def create_subscriber(cfgfile):
     """Create a new subscriber for all the remote hosts in cfgfile.
     """
@@ -72,8 +133,12 @@ def create_requesters(cfgfile):
     cfg.read(cfgfile)
     requesters = {}
     for host in cfg.get("local_reception", "remotehosts").split():
+        try:
+            packed = cfg.getboolean(host, "packed")
+        except NoOptionError:
+            packed = False
         host, port = (cfg.get(host, "hostname"),  cfg.get(host, "reqport"))
-        requesters[host] = Requester(host, port)
+        requesters[host] = Requester(host, port, packed)
     host = cfg.get("local_reception", "localhost")
     host, port = (cfg.get(host, "hostname"),  cfg.get(host, "reqport"))
     requesters[host] = Requester(host, port)
@@ -81,16 +146,19 @@ def create_requesters(cfgfile):
 
 class Requester(object):
 
-    """Make a request connection, waiting to get scanlines .
+    """Make a request connection, waiting to get scanlines . If *packed* is
+    True, ask for the scanlines to be sent packed on 10 bits per word.
     """
     
-    def __init__(self, host, port):
+    def __init__(self, host, port, packed=False):
         self._host = host
         self._port = port
+        self._packed = packed
+        self.address = "tcp://" + host + ":" + str(port)
         self._context = Context()
         self._socket = self._context.socket(REQ)
         self._socket.setsockopt(LINGER, 1)
-        self._socket.connect("tcp://"+host+":"+str(port))
+        self._socket.connect(self.address)
         self._poller = Poller()
         self._poller.register(self._socket, POLLIN)
 
@@ -116,17 +184,90 @@ class Requester(object):
             raise IOError("Timeout from " + str(self._host) +
                           ":" + str(self._port))
         
+    def line_request(self, satellite, utctime):
+        """Make the request for the scanline of *satellite* at *utctime*.
+        """
+        return Message('/oper/polar/direct_readout/norrköping',
+                       'request',
+                       {"type": "scanline",
+                        "satellite": satellite,
+                        "utctime": utctime.isoformat(),
+                        "packed": self._packed})
+
+    def line_data(self, resp):
+        """Get the scanline data out of the response *resp* to a line
+        request. Raises IOError if the server did not send the line.
+        """
+        if resp.type == "choke":
+            raise IOError("Choked by " + str(self._host) +
+                          ":" + str(self._port))
+        if resp.type == "packed_scanline":
+            return unpack_line(resp.data)
+        if resp.type != "scanline":
+            raise IOError(str(resp.data))
+        return resp.data
+
     def get_line(self, satellite, utctime):
         """Get the scanline of *satellite* at *utctime*.
         """
+        self.send(self.line_request(satellite, utctime))
+        return self.line_data(self.recv(LINE_TIMEOUT))
+
+    def get_stats(self):
+        """Get the statistics of the server. Only given to the local host.
+        """
         msg = Message('/oper/polar/direct_readout/norrköping',
                       'request',
-                      {"type": "scanline",
-                       "satellite": satellite,
-                       "utctime": utctime.isoformat()})
+                      {"type": "stats"})
         self.send(msg)
-        return self.recv(1000).data
-
+        resp = self.recv(1000)
+        if resp.type == "error":
+            raise IOError(str(resp.data))
+        return resp.data
+
+
+    def get_lines_bulk(self, satellite, start_time=None, end_time=None,
+                       utctimes=None):
+        """Get many scanlines of *satellite* in as few round trips as
+        possible, either all the lines between *start_time* and *end_time*,
+        or the lines at *utctimes*. Returns a list of (utctime, elevation,
+        data) for the lines the server has.
+        """
+        if utctimes is not None:
+            requests = [{"utctimes": [utctime.isoformat()
+                                      for utctime in utctimes[i:i + BULK_SIZE]]}
+                        for i in range(0, len(utctimes), BULK_SIZE)]
+        else:
+            requests = [{"start_time": start_time.isoformat(),
+                         "end_time": end_time.isoformat()}]
+
+        lines = []
+        while requests:
+            request = requests.pop(0)
+            request["type"] = "scanline_range"
+            request["satellite"] = satellite
+            request["packed"] = self._packed
+            msg = Message('/oper/polar/direct_readout/norrköping',
+                          'request', request)
+            self.send(msg)
+            if not self._poller.poll(BULK_TIMEOUT):
+                raise IOError("Timeout from " + str(self._host) +
+                              ":" + str(self._port))
+            frames = self._socket.recv_multipart()
+            header = Message(rawstr=frames[0])
+            if header.type in ["error", "choke"]:
+                raise IOError(str(header.data))
+            for (utcstr, elevation), data in zip(header.data["lines"],
+                                                 frames[1:]):
+                if header.data.get("packed"):
+                    data = unpack_line(data)
+                lines.append((strp_isoformat(utcstr), elevation, data))
+            if not header.data["complete"]:
+                # carry on after the last line we got
+                request["start_time"] = (lines[-1][0] +
+                                         timedelta(milliseconds=1)).isoformat()
+                requests.append(request)
+        return lines
 
     def get_slice(self, satellite, start_time, end_time):
         """Get a slice of scanlines.
@@ -155,8 +296,284 @@ class Requester(object):
         self.send(msg)
         self._socket.recv()         
 
+class HostStats(object):
+    """Moving averages of the response time and failure rate of a host.
+    """
+
+    def __init__(self, smoothing=EWMA_SMOOTHING):
+        self._smoothing = smoothing
+        self.latency = None
+        self.failure_rate = 0.0
+
+    def success(self, latency):
+        """Record an answer received after *latency* seconds.
+        """
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self._smoothing * (latency - self.latency)
+        self.failure_rate -= self._smoothing * self.failure_rate
+
+    def failure(self):
+        """Record a request left unanswered or refused.
+        """
+        self.failure_rate += self._smoothing * (1 - self.failure_rate)
+
+    def expected_time(self, backlog, window):
+        """Get the expected time to get a line from the host, given the
+        *backlog* of requests already queued or in flight to it.
+        """
+        latency = self.latency
+        if latency is None:
+            latency = LINE_TIMEOUT / 1000.0 / 10
+        return (latency * (1 + float(backlog) / window)
+                / max(1 - self.failure_rate, MIN_SUCCESS_RATE))
+
+class Fetcher(object):
+    """Fetch scanlines from several hosts at once, keeping at most *window*
+    requests in flight to each of the *requesters*, so that lines come at the
+    speed of the links rather than at one round trip per line.
+
+    Each line is asked to the announcing host with the best score, combining
+    the elevation of the line and the expected response time of the host.
+    When a host does not answer in time or refuses a line, the line is asked
+    to another host having it.
+
+    Not thread safe, meant to be used by the thread asking for the lines.
+    """
+
+    def __init__(self, requesters, window=FETCH_WINDOW):
+        self._requesters = requesters
+        self._window = window
+        self._context = Context()
+        self._poller = Poller()
+        self._sockets = {}
+        self._queued = {}
+        self._in_flight = {}
+        self._count = 0
+        self.stats = dict((host, HostStats()) for host in requesters)
+
+    def stop(self):
+        """Close the sockets.
+        """
+        for socket in self._sockets.values():
+            socket.close()
+        self._sockets = {}
+
+    def _socket(self, host):
+        """Get the socket to *host*.
+        """
+        try:
+            return self._sockets[host]
+        except KeyError:
+            socket = self._context.socket(DEALER)
+            socket.setsockopt(LINGER, 1)
+            socket.connect(self._requesters[host].address)
+            self._poller.register(socket, POLLIN)
+            self._sockets[host] = socket
+            return socket
+
+    def backlog(self, host):
+        """Get the number of requests queued or in flight to *host*.
+        """
+        return (len(self._queued.get(host, [])) +
+                sum(1 for req in self._in_flight.values()
+                    if req["host"] == host))
+
+    def busy(self):
+        """Tell if lines are still being fetched.
+        """
+        return bool(self._in_flight) or any(self._queued.values())
+
+    def score(self, host, elevation):
+        """Get the score of asking *host* for a line it has at *elevation*.
+        """
+        return (elevation - LATENCY_WEIGHT *
+                self.stats[host].expected_time(self.backlog(host),
+                                               self._window))
+
+    def choose(self, senders, tried=()):
+        """Choose the host to ask among *senders*, a list of (host, elevation),
+        leaving out the hosts *tried* already unless there is no other.
+        """
+        senders = [(host.split(":")[0], elevation)
+                   for host, elevation in senders
+                   if host.split(":")[0] in self._requesters]
+        untried = [sender for sender in senders if sender[0] not in tried]
+        senders = untried or senders
+        if not senders:
+            return None, None
+        return max(senders, key=lambda (host, elevation):
+                   self.score(host, elevation))
+
+    def submit(self, satellite, utctime, senders, tried=()):
+        """Ask for the line of *satellite* at *utctime* to one of *senders*.
+        """
+        host, elevation = self.choose(senders, tried)
+        if host is None:
+            logger.warning("No known host has " + satellite + " "
+                           + str(utctime))
+            return
+        self._queued.setdefault(host, []).append(
+            {"host": host,
+             "satellite": satellite,
+             "utctime": utctime,
+             "elevation": elevation,
+             "senders": senders,
+             "tried": tuple(tried) + (host, )})
+
+    def _retry(self, req, reason):
+        """Record the failure of *req*, and ask another host if there are
+        attempts left.
+        """
+        logger.warning("Could not get " + req["satellite"] + " "
+                       + str(req["utctime"]) + " from " + req["host"]
+                       + ": " + reason)
+        self.stats[req["host"]].failure()
+        if len(req["tried"]) < FETCH_ATTEMPTS:
+            self.submit(req["satellite"], req["utctime"], req["senders"],
+                        req["tried"])
+        # do not wait for the failing host to reject the requests queued
+        # for it, give them to other hosts now
+        for queued in self._queued.pop(req["host"], []):
+            self.submit(queued["satellite"], queued["utctime"],
+                        queued["senders"], queued["tried"])
+
+    def _send_queued(self):
+        """Send the queued requests the windows have room for.
+        """
+        in_flight = {}
+        for req in self._in_flight.values():
+            in_flight[req["host"]] = in_flight.get(req["host"], 0) + 1
+        for host, queued in self._queued.items():
+            room = self._window - in_flight.get(host, 0)
+            while queued and room > 0:
+                req = queued.pop(0)
+                self._count += 1
+                req_id = str(self._count)
+                logger.debug("requesting " + " ".join([str(req["satellite"]),
+                                                       str(req["utctime"]),
+                                                       str(host)]))
+                msg = self._requesters[host].line_request(req["satellite"],
+                                                          req["utctime"])
+                self._socket(host).send_multipart([req_id, "", str(msg)])
+                req["start"] = time.time()
+                self._in_flight[req_id] = req
+                room -= 1
+
+    def poll(self, timeout=FETCH_POLL):
+        """Send what can be sent, and wait at most *timeout* milliseconds for
+        lines. Returns the list of (satellite, utctime, data, elevation) of
+        the lines received.
+        """
+        self._send_queued()
+        if not self._sockets:
+            return []
+        lines = []
+        socks = dict(self._poller.poll(timeout))
+        for socket, event in socks.items():
+            if event != POLLIN:
+                continue
+            while True:
+                try:
+                    frames = socket.recv_multipart(NOBLOCK)
+                except ZMQError:
+                    break
+                try:
+                    req = self._in_flight.pop(frames[0])
+                except KeyError:
+                    # given up already
+                    continue
+                try:
+                    data = self._requesters[req["host"]].line_data(
+                        Message(rawstr=frames[-1]))
+                except IOError, err:
+                    self._retry(req, str(err))
+                    continue
+                self.stats[req["host"]].success(time.time() - req["start"])
+                lines.append((req["satellite"], req["utctime"], data,
+                              req["elevation"]))
+        self._expire()
+        self._send_queued()
+        return lines
+
+    def _expire(self):
+        """Give up the requests left unanswered for too long, and ask
+        another host.
+        """
+        now = time.time()
+        for req_id, req in self._in_flight.items():
+            if now - req["start"] > LINE_TIMEOUT / 1000.0:
+                del self._in_flight[req_id]
+                self._retry(req, "timeout")
+
+    def fetch(self, satellite, lines):
+        """Fetch the *lines* of *satellite*, a list of (utctime, senders),
+        and yield (utctime, data, elevation) in time order.
+        """
+        for utctime, senders in lines:
+            self.submit(satellite, utctime, senders)
+        waiting = sorted(utctime for utctime, senders in lines)
+        received = {}
+        while waiting:
+            for sat, utctime, data, elevation in self.poll():
+                received[utctime] = data, elevation
+            # lines given up on are not waited for
+            if not self.busy():
+                waiting = [utctime for utctime in waiting
+                           if utctime in received]
+            while waiting and waiting[0] in received:
+                utctime = waiting.pop(0)
+                data, elevation = received.pop(utctime)
+                yield utctime, data, elevation
+
+class Scheduler(Thread):
+    """Call *callback* with each of the scheduled keys once their deadline
+    has passed, all from this one thread.
+    """
+
+    def __init__(self, callback):
+        Thread.__init__(self)
+        self.daemon = True
+        self._callback = callback
+        self._heap = []
+        self._condition = Condition()
+        self._loop = True
+
+    def schedule(self, deadline, key):
+        """Schedule *key* for time.time() *deadline*.
+        """
+        with self._condition:
+            heappush(self._heap, (deadline, key))
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._loop:
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if not self._loop:
+                    return
+                key = heappop(self._heap)[1]
+            self._callback(key)
+
+    def stop(self):
+        """Stop scheduling.
+        """
+        with self._condition:
+            self._loop = False
+            self._condition.notify()
+
 class HaveBuffer(Thread):
-    """Listen to incomming have messages.
+    """Listen to incomming have messages. When several stations are
+    listened to, the lines are dispatched once all the stations announced
+    them, or at the latest BUFFER_TIME seconds after the first announcement.
     """
 
     def __init__(self, cfgfile="sattorrent.cfg"):
@@ -165,7 +582,9 @@ class HaveBuffer(Thread):
         self.scanlines = {}
         self._queues = []
         self._requesters = []
-        self._timers = {}
+        self._pending = set()
+        self._lock = Lock()
+        self._scheduler = Scheduler(self.release)
 
     def add_queue(self, queue):
         """Adds a queue to dispatch have messages to
@@ -180,75 +599,146 @@ class HaveBuffer(Thread):
     def send_to_queues(self, sat, utctime):
         """Send scanline at *utctime* to queues.
         """
-        try:
-            self._timers[(sat, utctime)].cancel()
-            del self._timers[(sat, utctime)]
-        except KeyError:
-            pass
         for queue in self._queues:
             queue.put_nowait((sat, utctime, self.scanlines[sat][utctime]))
-        
+
+    def release(self, key):
+        """Send the line of *key*, (sat, utctime), to the queues, unless it
+        was sent already.
+        """
+        with self._lock:
+            if key not in self._pending:
+                return
+            self._pending.remove(key)
+        self.send_to_queues(*key)
+
+    def add_have(self, sat, utctime, sender, elevation):
+        """Register that *sender* has the line of *sat* at *utctime*.
+        """
+        key = (sat, utctime)
+        with self._lock:
+            senders = self.scanlines.setdefault(sat, {}).get(utctime)
+            if senders is None:
+                self.scanlines[sat][utctime] = [(sender, elevation)]
+                if len(self._requesters) == 1:
+                    release = True
+                else:
+                    release = False
+                    self._pending.add(key)
+                    self._scheduler.schedule(time.time() + BUFFER_TIME, key)
+            else:
+                senders.append((sender, elevation))
+                release = (len(senders) == len(self._requesters)
+                           and key in self._pending)
+                if release:
+                    self._pending.remove(key)
+        if release:
+            self.send_to_queues(sat, utctime)
 
     def run(self):
+        self._scheduler.start()
 
         for message in self._sub.recv(1):
             if message is None:
                 continue
+            if message.type not in ["have", "haves"]:
+                continue
+            sat = message.data["satellite"]
+            # This should take care of address translation.
+            sender = (message.sender.split("@")[1] + ":" +
+                      message.data["origin"].split(":")[1])
             if(message.type == "have"):
-                sat = message.data["satellite"]
                 utctime = strp_isoformat(message.data["timecode"])
-                # This should take care of address translation.
-                sender = (message.sender.split("@")[1] + ":" +
-                          message.data["origin"].split(":")[1])
                 elevation = message.data["elevation"]
-                
-                self.scanlines.setdefault(sat, {})
-                if utctime not in self.scanlines[sat]:
-                    self.scanlines[sat][utctime] = [(sender, elevation)]
-                    # TODO: This implies that we always wait BUFFER_TIME before
-                    # sending to queue. In the case were the "have" messages of
-                    # all servers were sent in less time, we should not be
-                    # waiting...
-                    if len(self._requesters) == 1:
-                        self.send_to_queues(sat, utctime)
-                    else:
-                        timer = Timer(BUFFER_TIME,
-                                      self.send_to_queues,
-                                      args=[sat, utctime])
-                        timer.start()
-                        self._timers[(sat, utctime)] = timer
-                else:
-                    # Since append is atomic in CPython, this should work.
-                    # However, if it is not, then this is not thread safe.
-                    self.scanlines[sat][utctime].append((sender, elevation))
-                    if (len(self.scanlines[sat][utctime]) ==
-                        len(self._requesters)):
-                        self.send_to_queues(sat, utctime)
+                self.add_have(sat, utctime, sender, elevation)
+            else:
+                for utctime, elevation in decode_haves(message.data):
+                    self.add_have(sat, utctime, sender, elevation)
                 
     def stop(self):
         """Stop buffering.
         """
         self._sub.stop()
+        self._scheduler.stop()
+        if self._scheduler.is_alive():
+            self._scheduler.join()
 
-def compute_line_times(utctime, start_time, end_time):
-    """Compute the times of lines if a swath order depending on a reference
-    *utctime*.
+def to_msecs(utctime):
+    """Convert *utctime* to integer milliseconds since the epoch.
+    """
+    delta = utctime - EPOCH
+    return (delta.days * 86400000 + delta.seconds * 1000
+            + delta.microseconds // 1000)
+
+class LineGrid(object):
+    """The slots of the lines of a swath order between *start_time*
+    (inclusive) and *end_time* (exclusive), in phase with the line at
+    *utctime*, with bitmaps of the slots requested and received.
     """
-    offsets = (np.arange(0, 1, 1.0 / LINES_PER_SECOND) +
-               utctime.microsecond / 1000000.0)
-    offsets = offsets.round(3)
-    offsets[offsets > 1] -= 1
-    offsets -= start_time.microsecond
-    offset = timedelta(seconds=min(abs(offsets)))
-    time_diff = (end_time - start_time - offset)
-    time_diff = time_diff.seconds + time_diff.microseconds / 1000000.0
-    nblines = int(np.ceil(time_diff * LINES_PER_SECOND))
-    rst = start_time + offset
-    linepos = [rst + timedelta(seconds=round(i * 1.0/
-                                             LINES_PER_SECOND, 3))
-               for i in range(nblines)]
-    linepos = set(linepos)
-    return linepos
+
+    def __init__(self, utctime, start_time, end_time):
+        self._period = 1000.0 / LINES_PER_SECOND
+        self._ref = to_msecs(utctime)
+        # the timecodes are rounded to the millisecond
+        first = int(np.ceil((to_msecs(start_time) - self._ref - 0.5)
+                            / self._period))
+        end = int(np.ceil((to_msecs(end_time) - self._ref - 0.5)
+                          / self._period))
+        self._first = first
+        self.times = (self._ref + np.round(np.arange(first, max(end, first))
+                                           * self._period)).astype(np.int64)
+        self.requested = np.zeros(len(self.times), dtype=bool)
+        self.received = np.zeros(len(self.times), dtype=bool)
+        self._nb_received = 0
+        self._last_missing = len(self.times) - 1
+
+    def __len__(self):
+        return len(self.times)
+
+    def slot(self, utctime):
+        """Get the slot of the line at *utctime*, or None if it is not in the
+        order.
+        """
+        slot = (int(round((to_msecs(utctime) - self._ref) / self._period))
+                - self._first)
+        if slot < 0 or slot >= len(self.times):
+            return None
+        return slot
+
+    def receive(self, slot):
+        """Mark *slot* as received.
+        """
+        if not self.received[slot]:
+            self.received[slot] = True
+            self._nb_received += 1
+
+    def nb_missing(self):
+        """Get the number of lines not received yet.
+        """
+        return len(self.times) - self._nb_received
+
+    def last_missing(self):
+        """Get the time of the last line not received yet, or None.
+        """
+        # lines are received in increasing time order most of the time
+        while self._last_missing >= 0 and self.received[self._last_missing]:
+            self._last_missing -= 1
+        if self._last_missing < 0:
+            return None
+        return EPOCH + timedelta(
+            milliseconds=int(self.times[self._last_missing]))
+
+    def missing_ranges(self):
+        """Get the (first, last) times of the runs of consecutive lines not
+        received yet.
+        """
+        edges = np.diff(np.concatenate(([0], ~self.received, [0])).astype(
+            np.int8))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1) - 1
+        return [(EPOCH + timedelta(milliseconds=int(self.times[start])),
+                 EPOCH + timedelta(milliseconds=int(self.times[end])))
+                for start, end in zip(starts, ends)]
 
 class Client(HaveBuffer):
     """The client class.
@@ -258,21 +748,18 @@ class Client(HaveBuffer):
         HaveBuffer.__init__(self, cfgfile)
         self._requesters = create_requesters(cfgfile)
         self.cfgfile = cfgfile
+        cfg = ConfigParser()
+        cfg.read(cfgfile)
+        try:
+            window = cfg.getint("local_reception", "fetch_window")
+        except NoOptionError:
+            window = FETCH_WINDOW
+        self._fetcher = Fetcher(self._requesters, window)
 
     def get_lines(self, satellite, scanline_dict):
-        """Retrieve the best (highest elevation) lines of *scanline_dict*.
+        """Retrieve the best lines of *scanline_dict*, in time order.
         """
-
-        for utctime, hosts in scanline_dict.iteritems():
-            hostname, elevation = max(hosts, key=(lambda x: x[1]))
-            host = hostname.split(":")[0]
-
-            logger.debug("requesting " +  " ".join([str(satellite),
-                                                    str(utctime),
-                                                    str(host)]))
-            data = self._requesters[host].get_line(satellite, utctime)
-
-            yield utctime, data, elevation
+        return self._fetcher.fetch(satellite, scanline_dict.items())
 
 
 
@@ -288,25 +775,20 @@ class Client(HaveBuffer):
         try:
             while True:
                 try:
-                    sat, utctime, senders = queue.get(True,
-                                                      CLIENT_TIMEOUT.seconds)
-                    if sat not in satellites:
-                        continue
-                    sat_last_seen[sat] = datetime.utcnow()
-                    logger.debug("Picking line " + " ".join([str(utctime),
-                                                         str(senders)]))
-                    # choose the highest elevation
-                    sender, elevation = max(senders, key=(lambda x: x[1]))
-                    logger.debug("requesting " +
-                                 " ".join([str(sat), str(utctime),
-                                           str(sender), str(elevation)]))
-                    # TODO: this should be parallelized, and timed. I case of
-                    # failure, another source should be used. Choking ?
-                    line = self._requesters[sender.split(":")[0]].get_line(sat,
-                                                                       utctime)
-                    sat_lines[sat][utctime] = line
+                    # only block when there is nothing to fetch
+                    while True:
+                        sat, utctime, senders = queue.get(
+                            not self._fetcher.busy(), CLIENT_TIMEOUT.seconds)
+                        if sat not in satellites:
+                            continue
+                        sat_last_seen[sat] = datetime.utcnow()
+                        logger.debug("Picking line " +
+                                     " ".join([str(utctime), str(senders)]))
+                        self._fetcher.submit(sat, utctime, senders)
                 except Empty:
                     pass
+                for sat, utctime, line, elevation in self._fetcher.poll():
+                    sat_lines[sat][utctime] = line
                 for sat, utctime in sat_last_seen.items():
                     if utctime + CLIENT_TIMEOUT < datetime.utcnow():
                         # write the lines to file
@@ -343,18 +825,17 @@ class Client(HaveBuffer):
         start_time = time_slice.start
         end_time = time_slice.stop
 
-        saved = []
-
-
-        # Create a file of the right length, filled with zeros. The alternative
-        # would be to store all the scanlines in memory.
-        tsize = (end_time - start_time).seconds * LINES_PER_SECOND * LINE_SIZE
-        with open(filename, "wb") as fp_:
-            fp_.write("\x00" * (tsize))
-            
-        # Do the retrieval.
-        with open(filename, "r+b") as fp_:
-
+        # Create a sparse file of the right length, the disk space is only
+        # taken when the lines are written in it, through a memory map.
+        time_diff = end_time - start_time
+        time_diff = (time_diff.days * 86400 + time_diff.seconds
+                     + time_diff.microseconds / 1000000.0)
+        tsize = int(np.ceil(time_diff * LINES_PER_SECOND)) * LINE_SIZE
+        with open(filename, "w+b") as fp_:
+            fp_.truncate(tsize)
+            out = mmap.mmap(fp_.fileno(), tsize)
+
+            # Do the retrieval.
             queue = Queue()
             self.add_queue(queue)
 
@@ -365,9 +846,7 @@ class Client(HaveBuffer):
             # first, get the existing scanlines from self (client)
             logger.info("Getting list of existing scanlines from client.")
             for utctime, hosts in self.scanlines.get(satellite, {}).iteritems():
-                if(utctime >= start_time and
-                   utctime < end_time and
-                   utctime not in saved):
+                if utctime >= start_time and utctime < end_time:
                     lines_to_get[utctime] = hosts
                     
             # then, get scanlines from the server
@@ -377,6 +856,9 @@ class Client(HaveBuffer):
                     response = req.get_slice(satellite, start_time, end_time)
                     for utcstr, elevation in response:
                         utctime = strp_isoformat(utcstr)
+                        # the server includes the end time
+                        if utctime >= end_time:
+                            continue
                         lines_to_get.setdefault(utctime, []).append((host,
                                                                      elevation))
                 except IOError, e__:
@@ -389,18 +871,18 @@ class Client(HaveBuffer):
             for utctime, data, elevation in self.get_lines(satellite,
                                                            lines_to_get):
                 if linepos is None:
-                    linepos = compute_line_times(utctime, start_time, end_time)
-                
-                time_diff = utctime - start_time
-                time_diff = (time_diff.seconds
-                             + time_diff.microseconds / 1000000.0)
-                pos = LINE_SIZE * int(np.floor(time_diff * LINES_PER_SECOND))
-                fp_.seek(pos, 0)
-                fp_.write(data)
+                    linepos = LineGrid(utctime, start_time, end_time)
+
+                slot = linepos.slot(utctime)
+                if slot is None:
+                    logger.warning("Line out of the grid: " + str(utctime))
+                    continue
+                linepos.requested[slot] = True
+                pos = slot * LINE_SIZE
+                out[pos:pos + LINE_SIZE] = data
                 self.send_lineinfo_to_server(satellite, utctime, elevation,
                                              filename, pos)
-                saved.append(utctime)
-                linepos -= set([utctime])
+                linepos.receive(slot)
             
             # then, get the newly arrived scanlines
             logger.info("Getting new scanlines")
@@ -409,57 +891,49 @@ class Client(HaveBuffer):
             timethres = datetime.utcnow() + delay
             while ((start_time > datetime.utcnow()
                     or timethres > datetime.utcnow())
-                   and ((linepos is None) or (len(linepos) > 0))):
+                   and ((linepos is None) or (linepos.nb_missing() > 0))):
                 try:
-                    sat, utctime, senders = queue.get(True,
+                    # only block when there is nothing to fetch
+                    sat, utctime, senders = queue.get(not self._fetcher.busy(),
                                                       CLIENT_TIMEOUT.seconds)
                     logger.debug("Picking line " + " ".join([str(utctime),
                                                              str(senders)]))
-                    # choose the highest elevation
-                    sender, elevation = max(senders, key=(lambda x: x[1]))
 
-                except Empty:
-                    continue
+                    if sat == satellite and linepos is None:
+                        linepos = LineGrid(utctime, start_time, end_time)
 
-                if linepos is None:
-                    linepos = compute_line_times(utctime, start_time, end_time)
-
-                if(sat == satellite and
-                   utctime >= start_time and
-                   utctime < end_time and
-                   utctime not in saved):
-                    saved.append(utctime)
-
-                    # getting line
-                    logger.debug("requesting " +
-                                 " ".join([str(satellite), str(utctime),
-                                           str(sender), str(elevation)]))
-                    host = sender.split(":")[0]
-                    # TODO: this should be parallelized, and timed. I case of
-                    # failure, another source should be used. Choking ?
-                    line = self._requesters[host].get_line(satellite, utctime)
+                    if sat == satellite:
+                        slot = linepos.slot(utctime)
+                        if slot is not None and not linepos.requested[slot]:
+                            linepos.requested[slot] = True
+                            self._fetcher.submit(satellite, utctime, senders)
+                except Empty:
+                    pass
 
+                for sat, utctime, line, elevation in self._fetcher.poll():
                     # compute line position in file
-                    time_diff = utctime - start_time
-                    time_diff = (time_diff.seconds
-                                 + time_diff.microseconds / 1000000.0)
-                    pos = LINE_SIZE * int(np.floor(time_diff *
-                                                   LINES_PER_SECOND))
-                    fp_.seek(pos, 0)
-                    fp_.write(line)
+                    slot = linepos.slot(utctime)
+                    pos = slot * LINE_SIZE
+                    out[pos:pos + LINE_SIZE] = line
                     self.send_lineinfo_to_server(satellite, utctime, elevation,
                                                  filename, pos)
                     # removing from line check list
-                    linepos -= set([utctime])
+                    linepos.receive(slot)
 
                     delay = min(delay, datetime.utcnow() - utctime)
-                    if len(linepos) > 0:
-                        timethres = max(linepos) + CLIENT_TIMEOUT + delay
+                    if linepos.nb_missing() > 0:
+                        timethres = (linepos.last_missing() + CLIENT_TIMEOUT
+                                     + delay)
                     else:
                         timethres = datetime.utcnow()
 
             # shut down
             self.del_queue(queue)
+            out.close()
+            if linepos is not None:
+                for first, last in linepos.missing_ranges():
+                    logger.warning("Missing lines from " + str(first)
+                                   + " to " + str(last))
             
     def send_lineinfo_to_server(self, *args, **kwargs):
         """Send information to our own server.
@@ -474,6 +948,7 @@ class Client(HaveBuffer):
     
     def stop(self):
         HaveBuffer.stop(self)
+        self._fetcher.stop()
         for req in self._requesters.values():
             req.stop()
 
@@ -29,20 +29,24 @@ Limitations:
  - HRPT specific at the moment
 
 TODO:
- - Include files from a library, not only the currently written file to the
-   list of scanlines
- - Implement choking
  - de-hardcode filename
 """
 from __future__ import with_statement 
 
 import logging
+import mmap
 import os
+import re
+from base64 import b64decode, b64encode
+from bisect import bisect_left
+from collections import OrderedDict
 from ConfigParser import ConfigParser, NoOptionError
 from datetime import datetime, timedelta
 from fnmatch import fnmatch
 from glob import glob
-from threading import Thread, Lock
+from multiprocessing import Pool, cpu_count
+from socket import gethostname
+from threading import Thread, Event, Lock, local
 from urlparse import urlparse, urlunparse
 
 import numpy as np
@@ -53,7 +57,8 @@ from posttroll.subscriber import Subscriber
 from pyorbital.orbital import Orbital
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
-from zmq import Context, Poller, LINGER, PUB, REP, REQ, POLLIN, NOBLOCK
+from zmq import (Context, Poller, LINGER, PUB, REP, REQ, ROUTER, DEALER,
+                 POLLIN, NOBLOCK)
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -63,7 +68,40 @@ logger.setLevel(logging.DEBUG)
 
 LINE_SIZE = 11090 * 2
 
-CACHE_SIZE = 32
+# Size of a line packed on 10 bits per word, with its flag byte.
+PACKED_LINE_SIZE = 1 + (11090 + 2) * 10 // 8
+
+# Default byte budget of the scanline cache.
+CACHE_SIZE = 200 * 1024 * 1024
+
+# Seconds after which an unused file mapping is dropped.
+MAP_IDLE_TIME = 60
+
+# Default number of threads answering requests.
+WORKERS = 4
+
+# Polling timeout of the responder sockets, in milliseconds.
+POLL_TIMEOUT = 100
+
+# Maximum number of lines sent in response to one "scanline_range" request.
+BULK_SIZE = 600
+
+# Time after which a relayed request left unanswered by a mirror is given up,
+# in seconds.
+FORWARD_TIMEOUT = 5
+
+# First frame of the worker replies asking the Responder to relay a request.
+FORWARD = "trollcast forward"
+
+# Longest time a request of a partner is delayed to respect the upload rate,
+# in seconds.
+MAX_SHAPING_DELAY = 1.0
+
+# Default time during which "have" announcements are coalesced, in seconds.
+HAVE_WINDOW = 0.25
+
+# Default time between two retention sweeps of the Holder, in seconds.
+SWEEP_INTERVAL = 60
 
 HRPT_SYNC = np.array([ 994, 1011, 437, 701, 644, 277, 452, 467, 833, 224, 694,
         990, 220, 409, 1010, 403, 654, 105, 62, 867, 75, 149, 320, 725, 668,
@@ -75,18 +113,760 @@ HRPT_SYNC = np.array([ 994, 1011, 437, 701, 644, 277, 452, 467, 833, 224, 694,
         594, 496, 972], dtype=np.uint16)
 HRPT_SYNC_START = np.array([644, 367, 860, 413, 527, 149], dtype=np.uint16)
 
-def timecode(tc_array):
-    word = tc_array[0]
-    day = word
-    word = tc_array[1]
-    msecs = ((127) & word) * 1024
-    word = tc_array[2]
-    msecs += word & 1023
+EPOCH = datetime(1970, 1, 1)
+
+def to_msecs(utctime):
+    """Convert *utctime* to integer milliseconds since the epoch.
+    """
+    delta = utctime - EPOCH
+    return (delta.days * 86400000 + delta.seconds * 1000
+            + delta.microseconds // 1000)
+
+def from_msecs(msecs):
+    """Convert integer milliseconds since the epoch to a datetime.
+    """
+    return EPOCH + timedelta(milliseconds=int(msecs))
+
+# Number of lines decoded at once by the FileStreamer.
+BATCH_SIZE = 256
+
+# Length of the precomputed elevation tables, in seconds.
+PASS_LENGTH = 20 * 60
+
+# Default time after which a file that is not written to anymore is closed,
+# in seconds.
+FILE_IDLE_TIME = 60
+
+# Time between two lookups of the most recent TLE file, in seconds.
+TLE_CHECK_INTERVAL = 600
+
+HRPT_DTYPE = np.dtype([('frame_sync', '>u2', (6, )),
+                       ('id', [('id', '>u2'),
+                               ('spare', '>u2')]),
+                       ('timecode', '>u2', (4, )),
+                       ('telemetry', [("ramp_calibration", '>u2', (5, )),
+                                      ("PRT", '>u2', (3, )),
+                                      ("ch3_patch_temp", '>u2'),
+                                      ("spare", '>u2'),]),
+                       ('back_scan', '>u2', (10, 3)),
+                       ('space_data', '>u2', (10, 5)),
+                       ('sync', '>u2'),
+                       ('TIP_data', '>u2', (520, )),
+                       ('spare', '>u2', (127, )),
+                       ('image_data', '>u2', (2048, 5)),
+                       ('aux_sync', '>u2', (100, ))])
+
+def timecodes(tc_array):
+    """Decode an (n, 4) array of timecode words to milliseconds since the
+    start of the year.
+    """
+    tc_array = tc_array.astype(np.int64)
+    day = tc_array[:, 0] // 2 - 1
+    msecs = (tc_array[:, 1] & 127) * 1024
+    msecs += tc_array[:, 2] & 1023
     msecs *= 1024
-    word = tc_array[3]
-    msecs += word & 1023
+    msecs += tc_array[:, 3] & 1023
+    return day * 86400000 + msecs
+
+def decode_frames(data, year):
+    """Decode all the frames in *data*, which must hold a whole number of
+    lines. Returns the time of each line in milliseconds since the epoch and
+    the validity of its sync words.
+    """
+    frames = np.frombuffer(data, dtype=HRPT_DTYPE)
+    frame_sync = frames["frame_sync"].astype(np.uint16)
+    aux_sync = frames["aux_sync"].astype(np.uint16)
+    tcs = frames["timecode"].astype(np.uint16)
+
+    # frames not starting with the sync pattern are in the other byte order
+    swapped = np.all(abs(HRPT_SYNC_START.astype(np.int32) -
+                         frame_sync.astype(np.int32)) > 1, axis=1)
+    if swapped.any():
+        for array in (frame_sync, aux_sync, tcs):
+            array[swapped] = array[swapped].byteswap()
+
     # FIXME : should return current year !
-    return timedelta(days=int(day/2 - 1), milliseconds=int(msecs))
+    times = to_msecs(datetime(year, 1, 1)) + timecodes(tcs)
+    valid = (np.all(aux_sync == HRPT_SYNC, axis=1) &
+             np.all(frame_sync == HRPT_SYNC_START, axis=1))
+    return times, valid
+
+def latest_tle_file(tle_files):
+    """Get the most recent of the files matching the *tle_files* pattern, or
+    None if no pattern is given.
+    """
+    if tle_files is None:
+        return None
+    return max(glob(tle_files), key=lambda x: os.stat(x).st_mtime)
+
+def find_sync(data, start=0, end=None):
+    """Find the first frame sync pattern in *data* between byte offsets
+    *start* and *end*, at any byte offset and in either byte order. Returns
+    the byte offset of the pattern, or None if it is not found.
+    """
+    if end is None:
+        end = len(data)
+    nb_sync = len(HRPT_SYNC_START)
+    found = []
+    for shift in (0, 1):
+        nb_words = (end - start - shift) // 2
+        if nb_words < nb_sync:
+            continue
+        for dtype in (">u2", "<u2"):
+            words = np.frombuffer(data, dtype=dtype, count=nb_words,
+                                  offset=start + shift)
+            nb_pos = nb_words - nb_sync + 1
+            matches = words[:nb_pos] == HRPT_SYNC_START[0]
+            for i in range(1, nb_sync):
+                matches &= words[i:i + nb_pos] == HRPT_SYNC_START[i]
+            pos = np.flatnonzero(matches)
+            if len(pos):
+                found.append(start + shift + 2 * int(pos[0]))
+    if found:
+        return min(found)
+    return None
+
+def observer_elevations(orbital, times, coords):
+    """Compute in one call the elevations of the satellite of *orbital* at
+    epoch milliseconds *times*, seen from *coords* (lon, lat, alt).
+    """
+    utctimes = np.asarray(times, dtype=np.int64).astype("datetime64[ms]")
+    return np.asarray(orbital.get_observer_look(utctimes, *coords)[1])
+
+class ElevationTable(object):
+    """Elevations of a satellite over a pass, interpolated from a grid
+    computed every *step* seconds. The grid is recomputed to cover the next
+    *span* seconds whenever asked for times outside of it.
+    """
+
+    def __init__(self, orbital, coords, step, span=PASS_LENGTH):
+        self.orbital = orbital
+        self._coords = coords
+        self._step = int(step * 1000)
+        self._span = int(span * 1000)
+        self._times = np.zeros(0, dtype=np.int64)
+        self._elevations = np.zeros(0)
+
+    def __call__(self, times):
+        """Get the elevations at epoch milliseconds *times*.
+        """
+        if len(times) == 0:
+            return np.zeros(0)
+        first, last = times.min(), times.max()
+        if(len(self._times) == 0 or
+           first < self._times[0] or last > self._times[-1]):
+            start = first - first % self._step
+            end = max(last, start + self._span) + self._step
+            self._times = np.arange(start, end + 1, self._step)
+            self._elevations = observer_elevations(self.orbital,
+                                                   self._times,
+                                                   self._coords)
+        return np.interp(times, self._times, self._elevations)
+
+class ScanlineIndex(object):
+    """Time sorted catalog of the scanlines of one satellite.
+
+    Each line takes one slot in a set of column arrays (epoch milliseconds,
+    position in file, elevation, source id), kept sorted on time so that
+    lookups and time range queries are binary searches.
+
+    Readers do not lock. The columns and the number of lines are published
+    together as one snapshot tuple, and a published part of the columns is
+    never modified: new lines are appended past the end of the snapshot, and
+    any other change is made on new arrays. Writers must be serialized by the
+    caller.
+    """
+
+    LINE_BYTES = 8 + 8 + 4 + 4
+    DTYPES = (np.int64, np.int64, np.float32, np.int32)
+
+    def __init__(self, capacity=1024):
+        self._snapshot = (tuple(np.empty(capacity, dtype=dtype)
+                                for dtype in self.DTYPES), 0)
+        self._sources = []
+        self._source_index = {}
+
+    def __len__(self):
+        return self._snapshot[1]
+
+    def __contains__(self, msecs):
+        return self._find(msecs)[0] is not None
+
+    def _find(self, msecs):
+        """Get the slot of the line at *msecs*, or None, along with the
+        columns it was searched in.
+        """
+        columns, size = self._snapshot
+        pos = np.searchsorted(columns[0][:size], msecs)
+        if pos < size and columns[0][pos] == msecs:
+            return pos, columns
+        return None, columns
+
+    def _publish(self, columns, size, capacity):
+        """Publish the first *size* rows of *columns*, copied to new arrays
+        of *capacity* rows.
+        """
+        new_columns = []
+        for column, dtype in zip(columns, self.DTYPES):
+            new = np.empty(capacity, dtype=dtype)
+            new[:size] = column[:size]
+            new_columns.append(new)
+        self._snapshot = (tuple(new_columns), size)
+
+    def _source_id(self, source):
+        """Get the id of *source*, registering it if needed.
+        """
+        try:
+            return self._source_index[source]
+        except KeyError:
+            self._sources.append(source)
+            self._source_index[source] = len(self._sources) - 1
+            return self._source_index[source]
+
+    def add(self, msecs, line_start, source, elevation):
+        """Add a line to the index. Returns False if the line was already
+        there.
+        """
+        columns, size = self._snapshot
+        pos = np.searchsorted(columns[0][:size], msecs)
+        if pos < size and columns[0][pos] == msecs:
+            return False
+        if line_start is None:
+            line_start = -1
+        values = (msecs, line_start, elevation, self._source_id(source))
+        capacity = len(columns[0])
+        if pos == size and size < capacity:
+            # the slot is not visible to readers yet
+            for column, value in zip(columns, values):
+                column[size] = value
+            self._snapshot = (columns, size + 1)
+        else:
+            if size == capacity:
+                capacity = max(2 * capacity, 1)
+            self._publish([np.insert(column[:size], pos, value)
+                           for column, value in zip(columns, values)],
+                          size + 1, capacity)
+        return True
+
+    def add_many(self, times, line_starts, source_ids, sources, elevations):
+        """Add many lines at once. *source_ids* are indices in the list of
+        names *sources*, and line starts of -1 stand for None. Lines already
+        in the index are kept as they are.
+        """
+        if len(times) == 0:
+            return
+        local_ids = np.zeros(len(sources), dtype=np.int32)
+        for source_id in np.unique(source_ids):
+            local_ids[source_id] = self._source_id(sources[source_id])
+        old, size = self._snapshot
+        columns = [np.concatenate((old[0][:size], times)),
+                   np.concatenate((old[1][:size], line_starts)),
+                   np.concatenate((old[2][:size], elevations)),
+                   np.concatenate((old[3][:size], local_ids[source_ids]))]
+        # stable sort, so that the first occurrence of a time is the old one
+        order = np.argsort(columns[0], kind="mergesort")
+        unique = np.ones(len(order), dtype=bool)
+        unique[1:] = np.diff(columns[0][order]) != 0
+        order = order[unique]
+        self._publish([column[order] for column in columns], len(order),
+                      max(2 * len(order), len(old[0])))
+
+    def first(self):
+        """Get the time of the oldest line, or None if the index is empty.
+        """
+        columns, size = self._snapshot
+        if size:
+            return int(columns[0][0])
+        return None
+
+    def last(self):
+        """Get the time of the newest line, or None if the index is empty.
+        """
+        columns, size = self._snapshot
+        if size:
+            return int(columns[0][size - 1])
+        return None
+
+    def times(self):
+        """Get the times of all the lines.
+        """
+        columns, size = self._snapshot
+        return columns[0][:size]
+
+    def nbytes(self):
+        """Get the memory used by the column arrays.
+        """
+        return len(self._snapshot[0][0]) * self.LINE_BYTES
+
+    def drop_before(self, msecs):
+        """Remove the lines older than *msecs*. Returns the number of lines
+        removed.
+        """
+        columns, size = self._snapshot
+        return self.drop_oldest(np.searchsorted(columns[0][:size], msecs))
+
+    def drop_oldest(self, count):
+        """Remove the *count* oldest lines. Returns the number of lines
+        removed.
+        """
+        columns, size = self._snapshot
+        count = min(count, size)
+        if count <= 0:
+            return 0
+        size -= count
+        # give memory back when the index has shrunk a lot
+        capacity = len(columns[0])
+        if size < capacity // 4:
+            capacity = max(2 * size, 1024)
+        self._publish([column[count:count + size] for column in columns],
+                      size, capacity)
+        return count
+
+    def info(self, msecs):
+        """Get (line_start, source, elevation) for the line at *msecs*.
+        """
+        pos, columns = self._find(msecs)
+        if pos is None:
+            raise KeyError(msecs)
+        line_start = int(columns[1][pos])
+        if line_start < 0:
+            line_start = None
+        return (line_start,
+                self._sources[columns[3][pos]],
+                float(columns[2][pos]))
+
+    def range(self, start_msecs, end_msecs):
+        """Get the times and elevations of the lines between *start_msecs* and
+        *end_msecs*, inclusive.
+        """
+        columns, size = self._snapshot
+        times = columns[0][:size]
+        first = np.searchsorted(times, start_msecs, side="left")
+        last = np.searchsorted(times, end_msecs, side="right")
+        return (times[first:last].copy(),
+                columns[2][first:last].copy())
+
+class LineCache(object):
+    """Least recently used cache of raw scanlines, bounded in bytes.
+
+    Lines are partitioned per satellite. When the budget is exceeded, the
+    least recently used line of the largest partition is evicted, so that a
+    busy satellite does not flush the lines of the others.
+    """
+
+    def __init__(self, max_bytes=CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._partitions = {}
+        self._sizes = {}
+        self._lock = Lock()
+
+    def get(self, satellite, msecs):
+        """Get the line of *satellite* at *msecs*, or None if not cached.
+        """
+        with self._lock:
+            partition = self._partitions.get(satellite)
+            try:
+                line = partition.pop(msecs)
+            except (AttributeError, KeyError):
+                self.misses += 1
+                return None
+            partition[msecs] = line
+            self.hits += 1
+            return line
+
+    def add(self, satellite, msecs, line):
+        """Add the *line* of *satellite* at *msecs* to the cache.
+        """
+        if len(line) > self.max_bytes:
+            return
+        with self._lock:
+            partition = self._partitions.setdefault(satellite, OrderedDict())
+            old = partition.pop(msecs, None)
+            if old is not None:
+                self._sizes[satellite] -= len(old)
+                self.size -= len(old)
+            partition[msecs] = line
+            self._sizes[satellite] = self._sizes.get(satellite, 0) + len(line)
+            self.size += len(line)
+            while self.size > self.max_bytes:
+                sat = max(self._sizes, key=self._sizes.get)
+                old = self._partitions[sat].popitem(last=False)[1]
+                self._sizes[sat] -= len(old)
+                self.size -= len(old)
+                self.evictions += 1
+
+    def stats(self):
+        """Get the cache counters.
+        """
+        with self._lock:
+            return {"bytes": self.size,
+                    "max_bytes": self.max_bytes,
+                    "lines": dict((sat, len(partition))
+                                  for sat, partition
+                                  in self._partitions.items()),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+class MappedFiles(object):
+    """Pool of read-only memory mappings of data files.
+
+    A file is mapped on first access and remapped when a read goes past the
+    end of the mapping, which happens while the file is still being written.
+    Mappings unused for *idle_time* seconds are dropped. Dropped mappings are
+    not closed explicitly, they are released when the last view on them
+    goes away.
+    """
+
+    def __init__(self, idle_time=MAP_IDLE_TIME):
+        self._idle_time = idle_time
+        self._maps = {}
+        self._lock = Lock()
+        self._last_sweep = time.time()
+
+    def _map(self, path):
+        """Map the whole of *path*.
+        """
+        with open(path, "rb") as fp_:
+            try:
+                return mmap.mmap(fp_.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                return ""
+
+    def view(self, path, offset, size):
+        """Get a zero-copy view of *size* bytes of *path* at *offset*.
+        """
+        now = time.time()
+        with self._lock:
+            try:
+                mapping = self._maps[path][0]
+            except KeyError:
+                mapping = ""
+            if offset + size > len(mapping):
+                mapping = self._map(path)
+                if offset + size > len(mapping):
+                    raise IOError("Not enough data in " + path)
+            self._maps[path] = (mapping, now)
+            if now - self._last_sweep > self._idle_time:
+                self._sweep(now)
+        return buffer(mapping, offset, size)
+
+    def _sweep(self, now):
+        """Drop the mappings idle for too long.
+        """
+        for path, (mapping, last_used) in self._maps.items():
+            if now - last_used > self._idle_time:
+                logger.debug("Unmapping " + path)
+                del self._maps[path]
+        self._last_sweep = now
+
+def pack_line(line):
+    """Pack the 10-bit words of *line* on 10 bits each, 4 words in 5 bytes.
+    The first byte of the result gives the byte order of the original words,
+    "B" or "L", or is "R" if the line has wider words and is kept raw.
+    """
+    for dtype, flag in ((">u2", "B"), ("<u2", "L")):
+        words = np.frombuffer(line, dtype=dtype)
+        if words.max() < 1024:
+            break
+    else:
+        return "R" + str(line)
+    words = np.concatenate((words,
+                            np.zeros(-len(words) % 4, dtype=np.uint16)))
+    words = words.astype(np.uint64).reshape(-1, 4)
+    bits = np.zeros(len(words), dtype=np.uint64)
+    for i in range(4):
+        bits |= words[:, i] << np.uint64(10 * (3 - i))
+    packed = np.empty((len(words), 5), dtype=np.uint8)
+    for i in range(5):
+        packed[:, i] = (bits >> np.uint64(8 * (4 - i))) & np.uint64(255)
+    return flag + packed.tostring()
+
+def unpack_line(data):
+    """Unpack a line packed by pack_line.
+    """
+    flag, data = data[0], data[1:]
+    if flag == "R":
+        return data
+    packed = np.frombuffer(data, dtype=np.uint8).reshape(-1, 5)
+    packed = packed.astype(np.uint64)
+    bits = np.zeros(len(packed), dtype=np.uint64)
+    for i in range(5):
+        bits |= packed[:, i] << np.uint64(8 * (4 - i))
+    words = np.empty((len(packed), 4), dtype=np.uint16)
+    for i in range(4):
+        words[:, i] = (bits >> np.uint64(10 * (3 - i))) & np.uint64(1023)
+    words = words.ravel()[:LINE_SIZE // 2]
+    if flag == "B":
+        return words.astype(">u2").tostring()
+    return words.astype("<u2").tostring()
+
+def encode_haves(times, elevations):
+    """Encode epoch millisecond *times* and *elevations* for a "haves"
+    message.
+    """
+    return (b64encode(np.asarray(times, dtype="<i8").tostring()),
+            b64encode(np.asarray(elevations, dtype="<f4").tostring()))
+
+def decode_haves(data):
+    """Get the (utctime, elevation) list of the lines of a "haves" message.
+    """
+    times = np.frombuffer(b64decode(data["timecodes"]), dtype="<i8")
+    elevations = np.frombuffer(b64decode(data["elevations"]), dtype="<f4")
+    return zip([from_msecs(msecs) for msecs in times], elevations.tolist())
+
+class Histogram(object):
+    """Histogram of durations, in buckets of doubling width starting at 0.1
+    ms, cheap enough to be fed on every request.
+    """
+
+    BOUNDS = [0.0001 * 2 ** i for i in range(24)]
+
+    def __init__(self):
+        self._counts = [0] * (len(self.BOUNDS) + 1)
+        self._total = 0.0
+        self._max = 0.0
+
+    def record(self, duration):
+        """Add a *duration*, in seconds.
+        """
+        self._counts[bisect_left(self.BOUNDS, duration)] += 1
+        self._total += duration
+        self._max = max(self._max, duration)
+
+    def percentile(self, fraction):
+        """Get the upper bound of the bucket holding the given *fraction* of
+        the durations, in seconds.
+        """
+        rank = fraction * sum(self._counts)
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self._counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self._max)
+        return self._max
+
+    def summary(self):
+        """Get the count, mean, percentiles and maximum of the durations, in
+        milliseconds.
+        """
+        count = sum(self._counts)
+        if count == 0:
+            return {"count": 0}
+        return {"count": count,
+                "mean": self._total / count * 1000,
+                "p50": self.percentile(0.5) * 1000,
+                "p90": self.percentile(0.9) * 1000,
+                "p99": self.percentile(0.99) * 1000,
+                "max": self._max * 1000}
+
+class Metrics(object):
+    """Counters, service time histograms and bytes served per peer, shared by
+    the parts of the server.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._start = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._peers = {}
+
+    def count(self, name, amount=1):
+        """Add *amount* to the counter *name*.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def timing(self, name, duration):
+        """Record a *duration* in seconds in the histogram *name*.
+        """
+        with self._lock:
+            try:
+                histogram = self._histograms[name]
+            except KeyError:
+                histogram = self._histograms[name] = Histogram()
+            histogram.record(duration)
+
+    def served(self, sender, nb_bytes):
+        """Count *nb_bytes* sent to *sender* (user@host).
+        """
+        host = sender.split("@")[-1]
+        with self._lock:
+            self._peers[host] = self._peers.get(host, 0) + nb_bytes
+
+    def snapshot(self):
+        """Get the current values of all the metrics.
+        """
+        with self._lock:
+            return {"uptime": time.time() - self._start,
+                    "counters": dict(self._counters),
+                    "timings": dict((name, histogram.summary())
+                                    for name, histogram
+                                    in self._histograms.items()),
+                    "bytes_served": dict(self._peers)}
+
+class HaveBatcher(Thread):
+    """Coalesce the announcements of new lines, and publish them at most
+    every *window* seconds, in one "haves" message per satellite.
+    """
+
+    def __init__(self, holder, window=HAVE_WINDOW):
+        Thread.__init__(self)
+        self.daemon = True
+        self._holder = holder
+        self._window = window
+        self._pending = {}
+        self._lock = Lock()
+        self._loop = True
+
+    def add(self, satellite, msecs, elevation):
+        """Queue the announcement of a line.
+        """
+        with self._lock:
+            self._pending.setdefault(satellite, []).append((msecs, elevation))
+
+    def flush(self):
+        """Publish the queued announcements.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for satellite, lines in pending.items():
+            times, elevations = zip(*lines)
+            self._holder.send_haves(satellite, times, elevations)
+
+    def run(self):
+        while self._loop:
+            time.sleep(self._window)
+            self.flush()
+        self.flush()
+
+    def stop(self):
+        """Stop batching.
+        """
+        self._loop = False
+
+class Sweeper(Thread):
+    """Enforce the retention policy of a Holder every *interval* seconds.
+    """
+
+    def __init__(self, holder, interval=SWEEP_INTERVAL):
+        Thread.__init__(self)
+        self.daemon = True
+        self._holder = holder
+        self._interval = interval
+        self._loop = True
+
+    def run(self):
+        while self._loop:
+            time.sleep(self._interval)
+            self._holder.sweep()
+
+    def stop(self):
+        """Stop sweeping.
+        """
+        self._loop = False
+
+class StatsPublisher(Thread):
+    """Publish the statistics of a Holder every *interval* seconds.
+    """
+
+    def __init__(self, holder, interval):
+        Thread.__init__(self)
+        self.daemon = True
+        self._holder = holder
+        self._interval = interval
+        self._loop = True
+
+    def run(self):
+        while self._loop:
+            time.sleep(self._interval)
+            self._holder.send_stats()
+
+    def stop(self):
+        """Stop publishing.
+        """
+        self._loop = False
+
+CATALOG_DTYPE = np.dtype([("time", "<i8"),
+                          ("offset", "<i8"),
+                          ("elevation", "<f4"),
+                          ("satellite", "<i4"),
+                          ("source", "<i4")])
+
+class Catalog(object):
+    """Append-only record of the lines known to a Holder, kept on disk so
+    that they are not forgotten when the server restarts.
+
+    *path*.lines holds fixed size records of CATALOG_DTYPE, which can be read
+    or memory-mapped as one numpy array. The satellite and source fields are
+    line numbers in *path*.names, which holds the satellite and file names.
+    """
+
+    def __init__(self, path):
+        self._lines_path = path + ".lines"
+        self._names_path = path + ".names"
+        self._names = {}
+        self._lines_file = None
+        self._names_file = None
+
+    def load(self):
+        """Read the whole catalog. Returns the array of records and the list
+        of names, and opens the catalog for appending.
+        """
+        names = []
+        if os.path.exists(self._names_path):
+            with open(self._names_path, "rb") as fp_:
+                names = [name.rstrip("\n") for name in fp_]
+        self._names = dict((name, i) for i, name in enumerate(names))
+
+        records = np.zeros(0, dtype=CATALOG_DTYPE)
+        if os.path.exists(self._lines_path):
+            # skip a record left incomplete by a crash
+            count = os.path.getsize(self._lines_path) // CATALOG_DTYPE.itemsize
+            records = np.fromfile(self._lines_path, dtype=CATALOG_DTYPE,
+                                  count=count)
+            with open(self._lines_path, "r+b") as fp_:
+                fp_.truncate(count * CATALOG_DTYPE.itemsize)
+
+        self._names_file = open(self._names_path, "ab")
+        self._lines_file = open(self._lines_path, "ab")
+        return records, names
+
+    def _name_id(self, name):
+        """Get the id of *name*, writing it to the names file if needed.
+        """
+        try:
+            return self._names[name]
+        except KeyError:
+            self._names_file.write(name + "\n")
+            self._names_file.flush()
+            self._names[name] = len(self._names)
+            return self._names[name]
+
+    def add(self, satellite, msecs, line_start, source, elevation):
+        """Append a line to the catalog.
+        """
+        if line_start is None:
+            line_start = -1
+        record = np.array([(msecs, line_start, elevation,
+                            self._name_id(satellite),
+                            self._name_id(source))],
+                          dtype=CATALOG_DTYPE)
+        self._lines_file.write(record.tostring())
+        self._lines_file.flush()
+
+    def close(self):
+        """Close the catalog files.
+        """
+        for fp_ in (self._lines_file, self._names_file):
+            if fp_ is not None:
+                fp_.close()
 
 class Holder(object):
 
@@ -100,22 +880,203 @@ class Holder(object):
         self._addr = hostname + ":" + port
 
         self._station = cfg.get("local_reception", "station")
+        try:
+            cache_size = int(cfg.getfloat("local_reception", "cache_size")
+                             * 1024 * 1024)
+        except NoOptionError:
+            cache_size = CACHE_SIZE
 
         self._context = Context()
         self._socket = self._context.socket(PUB)
         self._socket.bind("tcp://*:" + port)
+        # serializes the writers, readers use the snapshots of the indices
         self._lock = Lock()
-        self._cache = []
+        self._cache = LineCache(cache_size)
+        self._files = MappedFiles()
+        self._pub_lock = Lock()
+        self.metrics = Metrics()
+
+        try:
+            window = cfg.getfloat("local_reception", "have_window")
+        except NoOptionError:
+            window = HAVE_WINDOW
+        if window > 0:
+            self._batcher = HaveBatcher(self, window)
+        else:
+            self._batcher = None
+
+        try:
+            self._max_age = timedelta(
+                hours=cfg.getfloat("local_reception", "max_age"))
+        except NoOptionError:
+            self._max_age = None
+        try:
+            self._max_lines = cfg.getint("local_reception", "max_lines")
+        except NoOptionError:
+            self._max_lines = None
+        try:
+            self._max_bytes = int(cfg.getfloat("local_reception", "max_bytes")
+                                  * 1024 * 1024)
+        except NoOptionError:
+            self._max_bytes = None
+        if(self._max_age is not None or self._max_lines is not None or
+           self._max_bytes is not None):
+            try:
+                interval = cfg.getfloat("local_reception", "sweep_interval")
+            except NoOptionError:
+                interval = SWEEP_INTERVAL
+            self._sweeper = Sweeper(self, interval)
+        else:
+            self._sweeper = None
+
+        try:
+            self._publisher = StatsPublisher(
+                self, cfg.getfloat("local_reception", "stats_interval"))
+        except NoOptionError:
+            self._publisher = None
+
+        try:
+            self._catalog = Catalog(cfg.get("local_reception", "catalog"))
+        except NoOptionError:
+            self._catalog = None
+        else:
+            self.restore()
         
         
     def __del__(self, *args, **kwargs):
         self._socket.close()
 
-    def get(self, *args, **kwargs):
-        return self._holder.get(*args, **kwargs)
+    def restore(self):
+        """Load the lines recorded in the catalog.
+        """
+        start = time.time()
+        records, names = self._catalog.load()
+        with self._lock:
+            for sat_id in np.unique(records["satellite"]):
+                lines = records[records["satellite"] == sat_id]
+                index = self._holder.setdefault(names[sat_id],
+                                                ScanlineIndex())
+                index.add_many(lines["time"], lines["offset"],
+                               lines["source"], names, lines["elevation"])
+        logger.info("Restored " + str(len(records)) + " lines from catalog in "
+                    + str(time.time() - start) + " seconds")
+
+    def start(self):
+        """Start publishing the coalesced announcements and the statistics,
+        and enforcing the retention policy.
+        """
+        if self._batcher is not None:
+            self._batcher.start()
+        if self._sweeper is not None:
+            self._sweeper.start()
+        if self._publisher is not None:
+            self._publisher.start()
 
-    def __getitem__(self, *args, **kwargs):
-        return self._holder.__getitem__(*args, **kwargs)
+    def stop(self):
+        """Stop publishing the coalesced announcements and the statistics,
+        and enforcing the retention policy, and close the catalog.
+        """
+        if self._publisher is not None:
+            self._publisher.stop()
+        if self._sweeper is not None:
+            self._sweeper.stop()
+        if self._batcher is not None:
+            self._batcher.stop()
+            self._batcher.join()
+        if self._catalog is not None:
+            self._catalog.close()
+
+    def sweep(self):
+        """Forget the lines that are too old, or too many.
+        """
+        dropped = 0
+        with self._lock:
+            if self._max_age is not None:
+                oldest = to_msecs(datetime.utcnow() - self._max_age)
+                for index in self._holder.values():
+                    dropped += index.drop_before(oldest)
+            if self._max_lines is not None:
+                for index in self._holder.values():
+                    dropped += index.drop_oldest(len(index) - self._max_lines)
+            if self._max_bytes is not None:
+                nb_lines = sum(len(index) for index in self._holder.values())
+                excess = nb_lines - self._max_bytes // ScanlineIndex.LINE_BYTES
+                if excess > 0:
+                    # drop the oldest lines, whatever their satellite
+                    times = np.concatenate([index.times() for index
+                                            in self._holder.values()])
+                    if excess < len(times):
+                        oldest = np.partition(times, excess)[excess]
+                    else:
+                        oldest = times.max() + 1
+                    for index in self._holder.values():
+                        dropped += index.drop_before(oldest)
+            for satellite, index in self._holder.items():
+                if len(index) == 0:
+                    del self._holder[satellite]
+        if dropped:
+            logger.info("Retention dropped " + str(dropped) + " lines")
+
+    def stats(self):
+        """Get the number of lines, the time span and the estimated memory
+        use of each satellite, the cache counters, and the metrics of the
+        server.
+        """
+        satellites = {}
+        for satellite, index in self._holder.items():
+            if len(index) == 0:
+                continue
+            satellites[satellite] = {"lines": len(index),
+                                     "bytes": index.nbytes(),
+                                     "first": from_msecs(index.first()),
+                                     "last": from_msecs(index.last())}
+        cache = self._cache.stats()
+        lookups = cache["hits"] + cache["misses"]
+        cache["hit_rate"] = float(cache["hits"]) / lookups if lookups else None
+        return {"satellites": satellites,
+                "bytes": sum(sat["bytes"] for sat in satellites.values()),
+                "cache": cache,
+                "metrics": self.metrics.snapshot()}
+
+    def stats_message(self):
+        """Make a "stats" message out of the statistics.
+        """
+        stats = self.stats()
+        for sat in stats["satellites"].values():
+            sat["first"] = sat["first"].isoformat()
+            sat["last"] = sat["last"].isoformat()
+        return Message('/oper/polar/direct_readout/' + self._station, "stats",
+                       stats)
+
+    def send_stats(self):
+        """Publish the statistics.
+        """
+        self._send(self.stats_message().encode())
+
+    def _send(self, msg):
+        """Publish *msg*. The announcements and the statistics can come from
+        different threads.
+        """
+        with self._pub_lock:
+            self._socket.send(msg)
+
+    def get_info(self, satellite, utctime):
+        """Get (line_start, filename, elevation) for the line of *satellite* at
+        *utctime*. Raises KeyError if the line is unknown.
+        """
+        return self._holder[satellite].info(to_msecs(utctime))
+
+    def get_slice(self, satellite, start_time, end_time):
+        """Get the (utctime, elevation) of the lines of *satellite* between
+        *start_time* and *end_time*, inclusive.
+        """
+        index = self._holder.get(satellite)
+        if index is None:
+            return []
+        times, elevations = index.range(to_msecs(start_time),
+                                        to_msecs(end_time))
+        return zip([from_msecs(msecs) for msecs in times],
+                   elevations.tolist())
     
     def send_have(self, satellite, utctime, elevation):
         """Sends 'have' message for *satellite*, *utctime*, *elevation*.
@@ -127,63 +1088,196 @@ class Holder(object):
         to_send["origin"] = self._addr
         msg = Message('/oper/polar/direct_readout/' + self._station, "have",
                       to_send).encode()
-        self._socket.send(msg)
+        self._send(msg)
+        self.metrics.count("haves_sent")
+
+    def send_haves(self, satellite, times, elevations):
+        """Sends one 'haves' message for the lines of *satellite* at epoch
+        milliseconds *times* and *elevations*.
+        """
+        to_send = {}
+        to_send["satellite"] = satellite
+        to_send["timecodes"], to_send["elevations"] = encode_haves(times,
+                                                                   elevations)
+        to_send["origin"] = self._addr
+        msg = Message('/oper/polar/direct_readout/' + self._station, "haves",
+                      to_send).encode()
+        self._send(msg)
+        self.metrics.count("haves_sent", len(times))
+        self.metrics.count("haves_messages")
+
+    def get_cached(self, satellite, utctime):
+        """Get the line of *satellite* at *utctime* if it is in the cache,
+        None otherwise.
+        """
+        return self._cache.get(satellite, to_msecs(utctime))
+
+    def cache_scanline(self, satellite, utctime, line):
+        """Keep *line* of *satellite* at *utctime* in the cache.
+        """
+        self._cache.add(satellite, to_msecs(utctime), line)
 
     def get_scanline(self, satellite, utctime):
-        info = self._holder[satellite][utctime]
-        if len(info) == 4:
-            return info[3]
-        else:
-            url = urlparse(self._holder[satellite][utctime][1])
-            with open(url.path, "rb") as fp_:
-                fp_.seek(self._holder[satellite][utctime][0])
-                return fp_.read(LINE_SIZE)
+        """Get the data of the line of *satellite* at *utctime*, either from
+        the cache or as a view on the mapped file.
+        """
+        msecs = to_msecs(utctime)
+        line = self._cache.get(satellite, msecs)
+        if line is None:
+            line_start, filename = self.get_info(satellite, utctime)[:2]
+            url = urlparse(filename)
+            line = self._files.view(url.path, line_start, LINE_SIZE)
+            self._cache.add(satellite, msecs, line)
+        return line
 
 
         
+    def add_lines(self, satellite, times, line_starts, filename, elevations):
+        """Add many lines of *satellite* from *filename* at once, without
+        announcing them. *times* are in epoch milliseconds.
+        """
+        with self._lock:
+            index = self._holder.setdefault(satellite, ScanlineIndex())
+            index.add_many(times, line_starts,
+                           np.zeros(len(times), dtype=np.int32), [filename],
+                           elevations)
+
     def add_scanline(self, satellite, utctime, elevation, line_start, filename, line=None):
         """Adds the scanline to the server. Typically used by the client to
         signal newly received lines.
         """
-        self._lock.acquire()
-        try:
-            if(satellite not in self._holder or
-               utctime not in self._holder[satellite]):
-                if line:
-                    self._holder.setdefault(satellite,
-                                            {})[utctime] = (line_start,
-                                                            filename,
-                                                            elevation,
-                                                            line)
-                    self._cache.append((satellite, utctime))
-                    while len(self._cache) > CACHE_SIZE:
-                        sat, deltime = self._cache[0]
-                        del self._cache[0]
-                        self._holder[sat][deltime] = \
-                                                self._holder[sat][deltime][:3]
-                        
-                else:
-                    self._holder.setdefault(satellite,
-                                            {})[utctime] = (line_start,
-                                                            filename,
-                                                            elevation)
+        msecs = to_msecs(utctime)
+        with self._lock:
+            index = self._holder.setdefault(satellite, ScanlineIndex())
+            added = index.add(msecs, line_start, filename, elevation)
+            if added and self._catalog is not None:
+                self._catalog.add(satellite, msecs, line_start, filename,
+                                  elevation)
+            if added and self._batcher is None:
                 self.send_have(satellite, utctime, elevation)
-        finally:
-            self._lock.release()
+        if added:
+            if line:
+                self._cache.add(satellite, msecs, line)
+            if self._batcher is not None:
+                self._batcher.add(satellite, msecs, elevation)
         
 
-class FileStreamer(FileSystemEventHandler):
-    """Get the updates from files.
+class OrbitalCache(object):
+    """Orbital objects of the satellites, built from the most recent of the
+    *tle_files*. The TLE files are looked up again at most every
+    *check_interval* seconds, and the Orbital objects are only rebuilt when a
+    newer TLE file shows up.
+    """
+
+    def __init__(self, tle_files, check_interval=TLE_CHECK_INTERVAL):
+        self._tle_files = tle_files
+        self._check_interval = check_interval
+        self._tle_file = None
+        self._last_check = None
+        self._orbitals = {}
+        self._lock = Lock()
+
+    def get(self, satellite):
+        """Get the Orbital of *satellite*.
+        """
+        with self._lock:
+            now = time.time()
+            if(self._last_check is None or
+               now - self._last_check > self._check_interval):
+                self._last_check = now
+                tle_file = latest_tle_file(self._tle_files)
+                if tle_file is not None:
+                    tle_file = (tle_file, os.stat(tle_file).st_mtime)
+                if tle_file != self._tle_file:
+                    self._tle_file = tle_file
+                    self._orbitals = {}
+            try:
+                return self._orbitals[satellite]
+            except KeyError:
+                orbital = Orbital(satellite, self._tle_file and
+                                  self._tle_file[0])
+                self._orbitals[satellite] = orbital
+                return orbital
+
+class TailedFile(Thread):
+    """Reading state of one HRPT file being written to, with the thread
+    ingesting it, so that files written at the same time, by several
+    antennas, are decoded in parallel. The lines are ingested by *streamer*
+    whenever *notify* is called, and the file is closed after *idle_time*
+    seconds without notification.
+    """
+
+    def __init__(self, path, streamer, idle_time=FILE_IDLE_TIME):
+        Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.year, self.satellite = parse_filename(path)
+        self.where = 0
+        self.elevations = None
+        self._file = None
+        self._streamer = streamer
+        self._idle_time = idle_time
+        self._modified = Event()
+        self._loop = True
+
+    def notify(self):
+        """Tell that the file was modified.
+        """
+        self._modified.set()
+
+    def run(self):
+        while self._loop:
+            if not self._modified.wait(self._idle_time):
+                if self.is_open():
+                    logger.debug("Closing idle file: " + self.path)
+                    self.close()
+                continue
+            self._modified.clear()
+            if not self._loop:
+                break
+            try:
+                self._streamer.ingest(self)
+            except Exception:
+                # do not let one file stop the tailing of the others
+                logger.exception("Failed to ingest " + self.path)
+        self.close()
+
+    def stop(self):
+        """Stop tailing the file.
+        """
+        self._loop = False
+        self._modified.set()
+
+    def read(self, size):
+        """Read at most *size* bytes from the current position, opening the
+        file if needed.
+        """
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        self._file.seek(self.where)
+        return self._file.read(size)
+
+    def close(self):
+        """Close the file, keeping the position in it.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
-    TODO: separate holder from file handling.
+    def is_open(self):
+        """Tell if the file is open.
+        """
+        return self._file is not None
+
+class FileStreamer(FileSystemEventHandler):
+    """Tail the HRPT files written in the data directory, and feed their
+    lines to the holder. Each file is read in its own thread, only when it is
+    modified, and is closed after *idle_time* seconds without modification.
     """
     def __init__(self, holder, configfile, *args, **kwargs):
         FileSystemEventHandler.__init__(self, *args, **kwargs)
-        self._file = None
-        self._filename = ""
-        self._where = 0
-        self._satellite = ""
-        self._orbital = None
+        self._files = {}
+        self._lock = Lock()
         cfg = ConfigParser()
         cfg.read(configfile)
         self._coords = cfg.get("local_reception", "coordinates").split(" ")
@@ -192,106 +1286,251 @@ class FileStreamer(FileSystemEventHandler):
                         float(self._coords[2])]
         logger.debug(self._coords)
         try:
-            self._tle_files = cfg.get("local_reception", "tle_files")
+            tle_files = cfg.get("local_reception", "tle_files")
         except NoOptionError:
-            self._tle_files = None
+            tle_files = None
+        self._orbitals = OrbitalCache(tle_files)
+        try:
+            self._elevation_step = cfg.getfloat("local_reception",
+                                                "elevation_step")
+        except NoOptionError:
+            self._elevation_step = None
+        try:
+            self._idle_time = cfg.getfloat("local_reception", "idle_time")
+        except NoOptionError:
+            self._idle_time = FILE_IDLE_TIME
 
         self._file_pattern = cfg.get("local_reception", "file_pattern")
         
         self.scanlines = holder
 
-    def on_created(self, event):
-        if event.src_path != self._filename:
-            logger.debug("Closing: " + self._filename)
-            if self._file:
-                self._file.close()
-            self._file = None
-            self._filename = ""
-            self._where = 0
-            self._satellite = ""
-        logger.debug("Creating: " + event.src_path)
-
-
-    def on_opened(self, event):
-        fname = os.path.split(event.src_path)[1]
-        if self._file is None and fnmatch(fname, self._file_pattern):
-            logger.debug("Opening: " + event.src_path)
-            self._filename = event.src_path
-            self._file = open(event.src_path, "rb")
-            self._where = 0
-            self._satellite = " ".join(event.src_path.split("_")[1:3])[:-5]
-
-            if self._tle_files is not None:
-                filelist = glob(self._tle_files)
-                tle_file = max(filelist, key=lambda x: os.stat(x).st_mtime)
-            else:
-                tle_file = None
-
-            self._orbital = Orbital(self._satellite, tle_file)
-            
+    def track(self, path):
+        """Get the reading state of the file at *path*, starting to tail it if
+        needed. Returns None if the file is not to be tailed.
+        """
+        with self._lock:
+            try:
+                return self._files[path]
+            except KeyError:
+                pass
+            if not fnmatch(os.path.split(path)[1], self._file_pattern):
+                return None
+            try:
+                tailed = TailedFile(path, self, self._idle_time)
+            except ValueError:
+                logger.warning("Not tailing " + path
+                               + ", cannot get its satellite")
+                return None
+            logger.debug("Tailing: " + path)
+            self._files[path] = tailed
+            tailed.start()
+            return tailed
+
+    def forget(self, path):
+        """Stop tailing the file at *path*.
+        """
+        with self._lock:
+            tailed = self._files.pop(path, None)
+        if tailed is not None:
+            logger.debug("Forgetting: " + path)
+            tailed.stop()
 
-    def on_modified(self, event):
-        self.on_opened(event)
+    def stop(self):
+        """Stop tailing all the files.
+        """
+        with self._lock:
+            tailed_files, self._files = self._files.values(), {}
+        for tailed in tailed_files:
+            tailed.stop()
+        for tailed in tailed_files:
+            tailed.join()
 
-        if event.src_path != self._filename:
-            return
-            
-        self._file.seek(self._where)
-        line = self._file.read(LINE_SIZE)
-        while len(line) == LINE_SIZE:
-            line_start = self._where
-            self._where = self._file.tell()
-            dtype = np.dtype([('frame_sync', '>u2', (6, )),
-                              ('id', [('id', '>u2'),
-                                      ('spare', '>u2')]),
-                              ('timecode', '>u2', (4, )),
-                              ('telemetry', [("ramp_calibration", '>u2', (5, )),
-                                             ("PRT", '>u2', (3, )),
-                                             ("ch3_patch_temp", '>u2'),
-                                             ("spare", '>u2'),]),
-                              ('back_scan', '>u2', (10, 3)),
-                              ('space_data', '>u2', (10, 5)),
-                              ('sync', '>u2'),
-                              ('TIP_data', '>u2', (520, )),
-                              ('spare', '>u2', (127, )),
-                              ('image_data', '>u2', (2048, 5)),
-                              ('aux_sync', '>u2', (100, ))])
-
-
-            array = np.fromstring(line, dtype=dtype)
-            if np.all(abs(HRPT_SYNC_START - 
-                          array["frame_sync"]) > 1):
-                array = array.newbyteorder()
-
-            # FIXME: this is bad!!!! Should not get the year from the filename
-            year = int(os.path.split(event.src_path)[1][:4])
-            utctime = datetime(year, 1, 1) + timecode(array["timecode"][0])
-
-            # Check that we receive real-time data
-            if not (np.all(array['aux_sync'] == HRPT_SYNC) and
-                    np.all(array['frame_sync'] == HRPT_SYNC_START)):
-                logger.info("Garbage line: " + str(utctime))
-                line = self._file.read(LINE_SIZE)
-                continue
+    def on_created(self, event):
+        if not event.is_directory:
+            self.track(event.src_path)
 
+    def on_deleted(self, event):
+        self.forget(event.src_path)
 
-            elevation = self._orbital.get_observer_look(utctime, *self._coords)[1]
-            logger.info("Got line " + utctime.isoformat() + " "
-                        + self._satellite + " "
-                        + str(elevation))
+    def on_moved(self, event):
+        self.forget(event.src_path)
 
+    def on_modified(self, event):
+        if event.is_directory:
+            return
+        tailed = self.track(event.src_path)
+        if tailed is not None:
+            tailed.notify()
 
-            
-            # TODO:
-            # - serve also already present files
-            # - timeout and close the file
-            self.scanlines.add_scanline(self._satellite, utctime,
-                                        elevation, line_start, self._filename,
-                                        line)
+    def get_elevations(self, tailed, times):
+        """Get the elevations of the satellite of *tailed* at epoch
+        milliseconds *times*.
+        """
+        orbital = self._orbitals.get(tailed.satellite)
+        if self._elevation_step:
+            if(tailed.elevations is None or
+               tailed.elevations.orbital is not orbital):
+                tailed.elevations = ElevationTable(orbital, self._coords,
+                                                   self._elevation_step)
+            return tailed.elevations(times)
+        return observer_elevations(orbital, times, self._coords)
+
+    def ingest(self, tailed):
+        """Read and decode the new lines of *tailed*, and add them to the
+        holder.
+        """
+        metrics = self.scanlines.metrics
+        while True:
+            # read a bit further to see the sync of the next line
+            raw = tailed.read(BATCH_SIZE * LINE_SIZE
+                              + 2 * len(HRPT_SYNC_START))
+            nb_lines = min(len(raw) // LINE_SIZE, BATCH_SIZE)
+            if nb_lines == 0:
+                break
+            batch_start = time.time()
+            data = raw[:nb_lines * LINE_SIZE]
+            times, valid = decode_frames(data, tailed.year)
+            elevations = np.zeros(nb_lines)
+            if valid.any():
+                elevations[valid] = self.get_elevations(tailed, times[valid])
+
+            consumed = nb_lines * LINE_SIZE
+            for i in range(nb_lines):
+                line_start = tailed.where + i * LINE_SIZE
+                utctime = from_msecs(times[i])
+
+                # Check that we receive real-time data
+                if not valid[i]:
+                    start = i * LINE_SIZE
+                    next_sync = find_sync(raw, start + 1)
+                    if next_sync == start + LINE_SIZE:
+                        logger.info("Garbage line: " + str(utctime))
+                        metrics.count("garbage_lines")
+                        continue
+                    # we lost the frame alignment, skip to the next frame
+                    consumed = next_sync
+                    if consumed is None:
+                        # the sync pattern could be cut at the end of raw
+                        consumed = max(len(raw) - 2 * len(HRPT_SYNC_START),
+                                       start + 1)
+                    logger.warning("Lost sync at byte " + str(line_start)
+                                   + " of " + tailed.path + ", skipping "
+                                   + str(consumed - start) + " bytes")
+                    metrics.count("bytes_skipped", consumed - start)
+                    break
+
+                elevation = float(elevations[i])
+                # the metrics tell the throughput, this is for debugging only
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Got line " + utctime.isoformat() + " "
+                                 + tailed.satellite + " "
+                                 + str(elevation))
+                metrics.count("lines_ingested")
+
+                self.scanlines.add_scanline(tailed.satellite, utctime,
+                                            elevation, line_start,
+                                            tailed.path,
+                                            data[i * LINE_SIZE:
+                                                 (i + 1) * LINE_SIZE])
+
+            tailed.where += consumed
+            metrics.count("bytes_read", consumed)
+            metrics.timing("ingest_batch", time.time() - batch_start)
+
+def parse_filename(path):
+    """Get the year and satellite of the HRPT file *path*, named either like
+    20120130134606_NOAA_18.temp or like 2012-01-30T13:46:06NOAA 18.hmf.
+    """
+    fname = os.path.split(path)[1]
+    match = re.search(r"([A-Za-z]+)[ _](\d+)\.\w+$", fname)
+    if match is None:
+        raise ValueError("Cannot find the satellite of " + path)
+    return int(fname[:4]), match.group(1).upper() + " " + match.group(2)
+
+def index_file(args):
+    """Find the valid lines of the HRPT file *path*, with their times,
+    positions and elevations seen from *coords*. Meant to be run in a worker
+    process, *args* is (path, coords, tle_files).
+    """
+    path, coords, tle_files = args
+    try:
+        year, satellite = parse_filename(path)
+        with open(path, "rb") as fp_:
+            data = mmap.mmap(fp_.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            nb_lines = len(data) // LINE_SIZE
+            times, valid = decode_frames(buffer(data, 0, nb_lines * LINE_SIZE),
+                                         year)
+        finally:
+            data.close()
+        times = times[valid]
+        offsets = np.arange(nb_lines, dtype=np.int64)[valid] * LINE_SIZE
+        elevations = np.zeros(len(times))
+        if len(times):
+            orbital = Orbital(satellite, latest_tle_file(tle_files))
+            elevations = observer_elevations(orbital, times, coords)
+    except Exception:
+        logger.exception("Cannot index " + path)
+        return None
+    return path, satellite, times, offsets, elevations
+
+class LibraryIndexer(object):
+    """Make the lines of the HRPT files of a library available, not only the
+    ones of the currently written files.
+    """
 
-            line = self._file.read(LINE_SIZE)
+    def __init__(self, holder, configfile):
+        cfg = ConfigParser()
+        cfg.read(configfile)
+        self._pattern = cfg.get("local_reception", "library")
+        coords = cfg.get("local_reception", "coordinates").split(" ")
+        self._coords = [float(coords[0]), float(coords[1]), float(coords[2])]
+        try:
+            self._tle_files = cfg.get("local_reception", "tle_files")
+        except NoOptionError:
+            self._tle_files = None
+        try:
+            self._workers = cfg.getint("local_reception", "library_workers")
+        except NoOptionError:
+            self._workers = cpu_count()
+        self._holder = holder
+        self._indexed = {}
+        self._lock = Lock()
 
-        self._file.seek(self._where)        
+    def scan(self):
+        """Index the files of the library that are new or changed since the
+        last scan.
+        """
+        with self._lock:
+            start = time.time()
+            mtimes = dict((path, os.stat(path).st_mtime)
+                          for path in glob(self._pattern))
+            paths = [path for path, mtime in mtimes.items()
+                     if self._indexed.get(path) != mtime]
+            if not paths:
+                return
+            nb_lines = 0
+            pool = Pool(min(self._workers, len(paths)))
+            try:
+                for result in pool.imap_unordered(index_file,
+                                                  [(path,
+                                                    self._coords,
+                                                    self._tle_files)
+                                                   for path in paths]):
+                    if result is None:
+                        continue
+                    path, satellite, times, offsets, elevations = result
+                    self._holder.add_lines(satellite, times, offsets, path,
+                                           elevations)
+                    nb_lines += len(times)
+            finally:
+                pool.close()
+                pool.join()
+            # files failing to index are not retried until they change
+            self._indexed.update((path, mtimes[path]) for path in paths)
+            logger.info("Indexed " + str(nb_lines) + " lines from "
+                        + str(len(paths)) + " library files in "
+                        + str(time.time() - start) + " seconds")
 
 class MirrorStreamer(Thread):
     """Act as a relay...
@@ -324,6 +1563,15 @@ class MirrorStreamer(Thread):
                                             message.data["elevation"],
                                             None,
                                             self._reqaddr)
+            elif(message.type == "haves"):
+                for utctime, elevation in decode_haves(message.data):
+                    logger.debug("Relaying " + str(utctime))
+                    self.scanlines.add_scanline(message.data["satellite"],
+                                                utctime,
+                                                elevation,
+                                                None,
+                                                self._reqaddr)
+
     def stop(self):
         """Stop streaming.
         """
@@ -341,7 +1589,7 @@ class Socket(object):
     def __init__(self, addr, stype):
         self._context = Context()
         self._socket = self._context.socket(stype)
-        if stype in [REP, PUB]:
+        if stype in [REP, PUB, ROUTER]:
             self._socket.bind(addr)
         else:
             self._socket.connect(addr)
@@ -360,7 +1608,165 @@ class SocketLooperThread(SocketLooper, Thread):
         Thread.__init__(self)
         SocketLooper.__init__(self, *args, **kwargs)
 
+class TokenBucket(object):
+    """Token bucket of *rate* bytes per second, holding at most one second
+    worth of tokens.
+    """
+
+    def __init__(self, rate):
+        self._rate = rate
+        self._tokens = rate
+        self._last = time.time()
+
+    def consume(self, amount):
+        """Take *amount* tokens if the bucket is not empty, and return 0.
+        Otherwise, return the time to wait before it is not empty anymore.
+        The bucket can go into debt, so that requests bigger than the bucket
+        still go through.
+        """
+        now = time.time()
+        self._tokens = min(self._tokens + (now - self._last) * self._rate,
+                           self._rate)
+        self._last = now
+        if self._tokens <= 0:
+            return -self._tokens / self._rate
+        self._tokens -= amount
+        return 0
+
+    def empty(self):
+        """Tell if the bucket is empty.
+        """
+        return self.consume(0) > 0
+
+class Choker(object):
+    """Share our upload bandwidth between the peers.
+
+    Partners, the stations we also get lines from, are only slowed down when
+    the total *upload_rate* is exceeded. The other peers get at most
+    *peer_rate* each, and are choked when either rate is exceeded. Rates are
+    in kB/s, requests from our own host are never limited.
+    """
+
+    def __init__(self, configfile):
+        cfg = ConfigParser()
+        cfg.read(configfile)
+        self._total = None
+        self._peer_rate = None
+        try:
+            self._total = TokenBucket(
+                cfg.getfloat("local_reception", "upload_rate") * 1024)
+        except NoOptionError:
+            pass
+        try:
+            self._peer_rate = cfg.getfloat("local_reception",
+                                           "peer_rate") * 1024
+        except NoOptionError:
+            pass
+        self._partners = set()
+        hosts = cfg.get("local_reception", "remotehosts").split()
+        try:
+            hosts.append(cfg.get("local_reception", "mirror"))
+        except NoOptionError:
+            pass
+        for host in hosts:
+            self._partners.add(cfg.get(host, "hostname").split(".")[0])
+        self._local = set([gethostname().split(".")[0],
+                           cfg.get(cfg.get("local_reception", "localhost"),
+                                   "hostname").split(".")[0],
+                           "localhost"])
+        self._peers = {}
+        self._lock = Lock()
+
+    def is_local(self, sender):
+        """Tell if *sender* (user@host) is on our own host.
+        """
+        return sender.split("@")[-1].split(".")[0] in self._local
+
+    def admit(self, sender, nb_bytes):
+        """Tell if *sender* (user@host) can be sent *nb_bytes* now. Partners
+        may have to wait a bit before being admitted.
+        """
+        host = sender.split("@")[-1].split(".")[0]
+        if host in self._local:
+            return True
+        if host in self._partners:
+            if self._total is None:
+                return True
+            waited = 0
+            while True:
+                with self._lock:
+                    delay = self._total.consume(nb_bytes)
+                if delay == 0 or waited >= MAX_SHAPING_DELAY:
+                    return True
+                delay = min(delay, MAX_SHAPING_DELAY - waited)
+                time.sleep(delay)
+                waited += delay
+        with self._lock:
+            if self._total is not None and self._total.empty():
+                return False
+            if self._peer_rate is not None:
+                bucket = self._peers.setdefault(host,
+                                                TokenBucket(self._peer_rate))
+                if bucket.consume(nb_bytes) > 0:
+                    return False
+            if self._total is not None:
+                self._total.consume(nb_bytes)
+            return True
+
+class ResponderWorker(Thread):
+    """Answer the requests dispatched by a Responder.
+    """
+
+    def __init__(self, responder, context, address):
+        Thread.__init__(self)
+        self._responder = responder
+        self._socket = context.socket(REP)
+        self._socket.setsockopt(LINGER, 1)
+        self._socket.connect(address)
+
+    def run(self):
+        poller = Poller()
+        poller.register(self._socket, POLLIN)
+        metrics = self._responder.metrics
+
+        while self._responder.is_looping():
+            socks = dict(poller.poll(timeout=POLL_TIMEOUT))
+            if self._socket in socks and socks[self._socket] == POLLIN:
+                start = time.time()
+                message = Message(rawstr=self._socket.recv(NOBLOCK))
+                kind = message.type
+                if isinstance(message.data, dict):
+                    kind = message.data.get("type", kind)
+                try:
+                    resp = self._responder.process(message)
+                except Exception, err:
+                    logger.exception("Failed to process " + str(message))
+                    resp = Message('/oper/polar/direct_readout/'
+                                   + self._responder.station,
+                                   "error", str(err))
+                    metrics.count("errors")
+                if isinstance(resp, list):
+                    frames = [str(resp[0])] + resp[1:]
+                    self._socket.send_multipart(frames, copy=False)
+                    if frames[0] == FORWARD:
+                        metrics.count("relayed")
+                    else:
+                        metrics.served(message.sender,
+                                       sum(len(frame) for frame in frames))
+                else:
+                    frame = str(resp)
+                    self._socket.send(frame)
+                    if resp.type == "choke":
+                        metrics.count("chokes")
+                    metrics.served(message.sender, len(frame))
+                metrics.count("requests " + kind)
+                metrics.timing(kind, time.time() - start)
+        self._socket.close()
+
 class Responder(SocketLooperThread):
+    """Dispatch the incoming requests to a pool of worker threads, so that a
+    slow request does not hold back the others.
+    """
 
     # TODO: this should not respond to everyone. It should check if the
     # requester is listed in the configuration file...
@@ -372,93 +1778,335 @@ class Responder(SocketLooperThread):
 
         cfg = ConfigParser()
         cfg.read(configfile)
-        self._station = cfg.get("local_reception", "station")
+        self.station = cfg.get("local_reception", "station")
+        try:
+            nb_workers = cfg.getint("local_reception", "workers")
+        except NoOptionError:
+            nb_workers = WORKERS
 
-        self.mirrors = {}
+        self._backend_address = "inproc://trollcast-workers-" + str(id(self))
+        self._backend = self._context.socket(DEALER)
+        self._backend.bind(self._backend_address)
+        self._workers = [ResponderWorker(self, self._context,
+                                         self._backend_address)
+                         for i in range(nb_workers)]
+
+        self._choker = Choker(configfile)
+        self.metrics = holder.metrics
+
+        self._local = local()
+        self._mirrors_lock = Lock()
+        self.mirrors = []
+
+        # asynchronous relaying, only used from the run thread
+        self._relays = {}
+        self._relayed = {}
+        self._relay_ids = {}
+        self._relay_count = 0
+
+        self.library = None
 
 
     def __del__(self, *args, **kwargs):
         self._socket.close()
-        for mirror in self.mirrors.values():
+        self._backend.close()
+        for mirror in self.mirrors + self._relays.values():
             mirror.close()
-            
+
+    def is_looping(self):
+        """Tell if the responder is still running.
+        """
+        return self._loop
         
     def forward_request(self, address, message):
-        """Forward a request to another server.
+        """Forward a request to another server. Each worker thread has its own
+        connections to the mirrors.
         """
-        if address not in self.mirrors:
-            context = Context()
-            socket = context.socket(REQ)
+        mirrors = self._local.__dict__.setdefault("mirrors", {})
+        if address not in mirrors:
+            socket = self._context.socket(REQ)
             socket.setsockopt(LINGER, 1)
             socket.connect(address)
-            self.mirrors[address] = socket
+            mirrors[address] = socket
+            with self._mirrors_lock:
+                self.mirrors.append(socket)
         else:
-            socket = self.mirrors[address]
+            socket = mirrors[address]
         socket.send(str(message))
         return socket.recv()
 
+    def fetch_relayed(self, satellite, utctime, address):
+        """Get the line of *satellite* at *utctime* from the mirror at
+        *address*, and keep it in the cache.
+        """
+        line = self._holder.get_cached(satellite, utctime)
+        if line is None:
+            request = Message('/oper/polar/direct_readout/' + self.station,
+                              "request",
+                              {"type": "scanline",
+                               "satellite": satellite,
+                               "utctime": utctime.isoformat(),
+                               "packed": True})
+            resp = Message(rawstr=self.forward_request(address, request))
+            if resp.type == "packed_scanline":
+                line = unpack_line(resp.data)
+            else:
+                line = resp.data
+            self._holder.cache_scanline(satellite, utctime, line)
+        return line
+
+    def choke_message(self):
+        """Make the response telling a peer it is choked.
+        """
+        return Message('/oper/polar/direct_readout/' + self.station,
+                       "choke", "upload rate exceeded, try again later")
+
+    def scanline_message(self, line, packed=False):
+        """Make the response carrying *line*, *packed* or not.
+        """
+        if packed:
+            return Message('/oper/polar/direct_readout/'
+                           + self.station,
+                           "packed_scanline",
+                           pack_line(line),
+                           binary=True)
+        return Message('/oper/polar/direct_readout/'
+                       + self.station,
+                       "scanline",
+                       str(line),
+                       binary=True)
+
+    def relay(self, envelope, address, satellite, msecs, packed):
+        """Ask the mirror at *address* for the line of *satellite* at
+        *msecs*, without waiting for the answer. The requester identified by
+        *envelope* is answered by *relay_answer*, together with all the other
+        requesters of the same line.
+        """
+        key = (satellite, msecs)
+        if key in self._relayed:
+            self._relayed[key][1].append((envelope, packed))
+            return
+        try:
+            socket = self._relays[address]
+        except KeyError:
+            socket = self._context.socket(DEALER)
+            socket.setsockopt(LINGER, 1)
+            socket.connect(address)
+            self._relays[address] = socket
+        self._relay_count += 1
+        relay_id = str(self._relay_count)
+        request = Message('/oper/polar/direct_readout/' + self.station,
+                          "request",
+                          {"type": "scanline",
+                           "satellite": satellite,
+                           "utctime": from_msecs(msecs).isoformat(),
+                           "packed": True})
+        socket.send_multipart([relay_id, "", str(request)])
+        self._relayed[key] = (time.time(), [(envelope, packed)], relay_id)
+        self._relay_ids[relay_id] = key
+
+    def relay_answer(self, socket):
+        """Answer the requesters of a line that was relayed through *socket*,
+        and keep the line in the cache.
+        """
+        frames = socket.recv_multipart()
+        try:
+            satellite, msecs = self._relay_ids.pop(frames[0])
+        except KeyError:
+            # given up already
+            return
+        waiting = self._relayed.pop((satellite, msecs))[1]
+        resp = Message(rawstr=frames[-1])
+        if resp.type == "packed_scanline":
+            line = unpack_line(resp.data)
+        elif resp.type == "scanline":
+            line = resp.data
+        else:
+            for envelope, packed in waiting:
+                self._socket.send_multipart(envelope + [frames[-1]])
+            return
+        self._holder.cache_scanline(satellite, from_msecs(msecs), line)
+        self.metrics.count("relay_answers")
+        for envelope, packed in waiting:
+            self._socket.send_multipart(
+                envelope + [str(self.scanline_message(line, packed))])
+
+    def expire_relays(self):
+        """Give up the relayed requests left unanswered for too long.
+        """
+        now = time.time()
+        for key, (start, waiting, relay_id) in self._relayed.items():
+            if now - start > FORWARD_TIMEOUT:
+                logger.warning("No answer from mirror for "
+                               + key[0] + " " + str(from_msecs(key[1])))
+                self.metrics.count("relay_timeouts")
+                del self._relayed[key]
+                del self._relay_ids[relay_id]
+
+    def get_range(self, message):
+        """Get the response to a "scanline_range" request, asking either for
+        the lines between *start_time* and *end_time* or for the lines at
+        *utctimes*. The response is a list of frames: a message listing the
+        times and elevations of the lines sent, followed by the lines
+        themselves, packed if *packed* is set in the request.
+        """
+        packed = message.data.get("packed", False)
+        sat = message.data["satellite"]
+        if "utctimes" in message.data:
+            lines = []
+            for utcstr in message.data["utctimes"]:
+                utctime = strp_isoformat(utcstr)
+                try:
+                    lines.append((utctime,
+                                  self._holder.get_info(sat, utctime)[2]))
+                except KeyError:
+                    pass
+        else:
+            lines = self._holder.get_slice(
+                sat,
+                strp_isoformat(message.data["start_time"]),
+                strp_isoformat(message.data["end_time"]))
+
+        line_size = PACKED_LINE_SIZE if packed else LINE_SIZE
+        if not self._choker.admit(message.sender,
+                                  line_size * len(lines[:BULK_SIZE])):
+            return self.choke_message()
+
+        frames = []
+        for utctime, elevation in lines[:BULK_SIZE]:
+            url = urlparse(self._holder.get_info(sat, utctime)[1])
+            if url.scheme in ["", "file"]:
+                frames.append(self._holder.get_scanline(sat, utctime))
+            else:
+                frames.append(self.fetch_relayed(sat, utctime,
+                                                 urlunparse(url)))
+        if packed:
+            frames = [pack_line(frame) for frame in frames]
+
+        header = Message('/oper/polar/direct_readout/' + self.station,
+                         "scanline_range",
+                         {"lines": [(utctime.isoformat(), elevation)
+                                    for utctime, elevation
+                                    in lines[:BULK_SIZE]],
+                          "complete": len(lines) <= BULK_SIZE,
+                          "packed": packed})
+        return [header] + frames
+
+    def process(self, message):
+        """Get the response to the request *message*.
+        """
+        # send list of scanlines
+        if(message.type == "request" and
+           message.data["type"] == "scanlines"):
+            sat = message.data["satellite"]
+            epoch = "1950-01-01T00:00:00"
+            start_time = strp_isoformat(message.data.get("start_time",
+                                                         epoch))
+            end_time = strp_isoformat(message.data.get("end_time",
+                                                       epoch))
+
+            return Message('/oper/polar/direct_readout/' + self.station,
+                           "scanlines",
+                           [(utctime.isoformat(), elevation)
+                            for utctime, elevation
+                            in self._holder.get_slice(sat,
+                                                      start_time,
+                                                      end_time)])
+
+        # send one scanline
+        elif(message.type == "request" and
+             message.data["type"] == "scanline"):
+            sat = message.data["satellite"]
+            utctime = strp_isoformat(message.data["utctime"])
+            url = urlparse(self._holder.get_info(sat, utctime)[1])
+            packed = message.data.get("packed", False)
+            if not self._choker.admit(message.sender,
+                                      PACKED_LINE_SIZE if packed
+                                      else LINE_SIZE):
+                return self.choke_message()
+            if url.scheme in ["", "file"]: # data is locally stored.
+                line = self._holder.get_scanline(sat, utctime)
+            else: # it's the address of a remote server.
+                line = self._holder.get_cached(sat, utctime)
+                if line is None:
+                    # let the run thread relay it
+                    return [FORWARD, str(urlunparse(url)), str(sat),
+                            str(to_msecs(utctime)), str(int(packed))]
+            return self.scanline_message(line, packed)
+
+        # send many scanlines at once
+        elif(message.type == "request" and
+             message.data["type"] == "scanline_range"):
+            return self.get_range(message)
+
+        # take in a new scanline
+        elif(message.type == "notice" and
+             message.data["type"] == "scanline"):
+            sat = message.data["satellite"]
+            utctime = message.data["utctime"]
+            elevation = message.data["elevation"]
+            filename = message.data["filename"]
+            line_start = message.data["file_position"]
+            utctime = strp_isoformat(utctime)
+            self._holder.add_scanline(sat, utctime, elevation,
+                                      line_start, filename)
+            return Message('/oper/polar/direct_readout/'
+                           + self.station,
+                           "notice",
+                           "ack")
+
+        # send the statistics, only to the local host
+        elif(message.type == "request" and
+             message.data["type"] == "stats"):
+            if not self._choker.is_local(message.sender):
+                raise ValueError("Statistics are only given to local hosts")
+            return self._holder.stats_message()
+
+        # index the library again
+        elif(message.type == "notice" and
+             message.data["type"] == "library" and
+             self.library is not None):
+            Thread(target=self.library.scan).start()
+            return Message('/oper/polar/direct_readout/'
+                           + self.station,
+                           "notice",
+                           "ack")
+
+        raise ValueError("Unknown request " + str(message.type))
 
     def run(self):
+        for worker in self._workers:
+            worker.start()
+
         poller = Poller()
         poller.register(self._socket, POLLIN)
+        poller.register(self._backend, POLLIN)
+        relays = set()
         
         while self._loop:
-            socks = dict(poller.poll(timeout=2))
-            if self._socket in socks and socks[self._socket] == POLLIN:
-                message = Message(rawstr=self._socket.recv(NOBLOCK))
-                
-                # send list of scanlines
-                if(message.type == "request" and
-                   message.data["type"] == "scanlines"):
-                    sat = message.data["satellite"]
-                    epoch = "1950-01-01T00:00:00"
-                    start_time = strp_isoformat(message.data.get("start_time",
-                                                                 epoch))
-                    end_time = strp_isoformat(message.data.get("end_time",
-                                                               epoch))
-
-                    resp = Message('/oper/polar/direct_readout/' + self._station,
-                                   "scanlines",
-                                   [(utctime.isoformat(),
-                                     self._holder[sat][utctime][2])
-                                    for utctime in self._holder.get(sat, [])
-                                    if utctime >= start_time
-                                    and utctime <= end_time])
-                    self._socket.send(str(resp))
-
-                # send one scanline
-                elif(message.type == "request" and
-                     message.data["type"] == "scanline"):
-                    sat = message.data["satellite"]
-                    utctime = strp_isoformat(message.data["utctime"])
-                    url = urlparse(self._holder[sat][utctime][1])
-                    if url.scheme in ["", "file"]: # data is locally stored.
-                        resp = Message('/oper/polar/direct_readout/'
-                                       + self._station,
-                                       "scanline",
-                                       self._holder.get_scanline(sat, utctime),
-                                       binary=True)
-                    else: # it's the address of a remote server.
-                        resp = self.forward_request(urlunparse(url),
-                                                    message)
-                    self._socket.send(str(resp))
-
-                # take in a new scanline
-                elif(message.type == "notice" and
-                     message.data["type"] == "scanline"):
-                    sat = message.data["satellite"]
-                    utctime = message.data["utctime"]
-                    elevation = message.data["elevation"]
-                    filename = message.data["filename"]
-                    line_start = message.data["file_position"]
-                    utctime = strp_isoformat(utctime)
-                    self._holder.add_scanline(sat, utctime, elevation,
-                                              line_start, filename)
-                    resp = Message('/oper/polar/direct_readout/'
-                                       + self._station,
-                                       "notice",
-                                       "ack")
-                    self._socket.send(str(resp))
+            socks = dict(poller.poll(timeout=POLL_TIMEOUT))
+            if socks.get(self._socket) == POLLIN:
+                self._backend.send_multipart(self._socket.recv_multipart())
+            if socks.get(self._backend) == POLLIN:
+                frames = self._backend.recv_multipart()
+                delimiter = frames.index("")
+                if frames[delimiter + 1] == FORWARD:
+                    address, sat, msecs, packed = frames[delimiter + 2:]
+                    self.relay(frames[:delimiter + 1], address, sat,
+                               int(msecs), bool(int(packed)))
+                else:
+                    self._socket.send_multipart(frames)
+            for socket in relays:
+                if socks.get(socket) == POLLIN:
+                    self.relay_answer(socket)
+            for socket in self._relays.values():
+                if socket not in relays:
+                    poller.register(socket, POLLIN)
+                    relays.add(socket)
+            self.expire_relays()
+
+        for worker in self._workers:
+            worker.join()
                 
     def stop(self):
         self._loop = False
@@ -469,6 +2117,7 @@ def main(configfile):
     """
 
     scanlines = Holder(configfile)
+    scanlines.start()
     fstreamer = FileStreamer(scanlines, configfile)
     notifier = Observer()
     cfg = ConfigParser()
@@ -480,7 +2129,14 @@ def main(configfile):
     local_station = cfg.get("local_reception", "localhost")
     responder_port = cfg.get(local_station, "reqport")
     responder = Responder(scanlines, configfile,
-                          "tcp://*:" + responder_port, REP)
+                          "tcp://*:" + responder_port, ROUTER)
+
+    try:
+        responder.library = LibraryIndexer(scanlines, configfile)
+        Thread(target=responder.library.scan).start()
+    except NoOptionError:
+        pass
+
     responder.start()
 
     mirror = None
@@ -499,6 +2155,8 @@ def main(configfile):
     
     responder.stop()
     notifier.join()
+    fstreamer.stop()
+    scanlines.stop()
 
     if mirror is not None:
         mirror.stop()